@@ -6,19 +6,21 @@ class Instruction:
         self.op, self.pc, self.rs1, self.rs2, self.rd, self.imm = \
             op, pc, rs1, rs2, rd, imm
         self.stage, self.rs1_val, self.rs2_val, self.result = '---', None, None, None
+        self.spec_tag = None   # set on fetched copies while the BPU speculates past an unresolved branch
 
     def __str__(self):
         return self.op if self.op else "---"
 
+    # Operations that write rd; an ISA front end's instruction subclass adds its own
+    WRITES_RD = frozenset([
+        "add", "sub", "xor", "or", "and", "sll", "slt", "sltu", "srl", "sra",
+        "addi", "xori", "ori", "andi", "slli", "srli", "srai", "slti", "sltiu",
+        "auipc", "lui", "lb", "lh", "lw", "lbu", "lhu", "jal", "jalr"
+    ])
+
     def get_dest_reg(self):
         """Returns the destination register number based on the instruction type."""
-        if self.op in [
-            "add", "sub", "xor", "or", "and", "sll", "slt", "sltu", "srl", "sra",
-            "addi", "xori", "ori", "andi", "slli", "srli", "srai", "slti", "sltiu",
-            "auipc", "lui", "lb", "lh", "lw", "lbu", "lhu", "jal", "jalr"
-        ]:
-            return self.rd
-        return None
+        return self.rd if self.op in self.WRITES_RD else None
 
 # RISC-V Application Binary Interface (ABI) Register Names
 REG_NAME_MAP = {
@@ -28,5 +30,6 @@ REG_NAME_MAP = {
     "24": "s8", "25": "s9", "26": "s10", "27": "s11", "28": "t3", "29": "t4", "30": "t5", "31": "t6"
 }
 INV_REG_NAME_MAP = {v: k for k, v in REG_NAME_MAP.items()}
-Directive = collections.namedtuple('Directive', ['is_taken', 'target_pc'])
+# flush=0 keeps the IF instruction (branch was instr2); flush=1 squashes it
+Directive = collections.namedtuple('Directive', ['is_taken', 'target_pc', 'flush'], defaults=(1,))
 
@@ -0,0 +1,246 @@
+"""Batched architectural execution: one RV32I program run on many input data sets at once.
+
+Registers and data memory are NumPy arrays with a leading instance dimension, and each instruction
+is applied to every instance waiting at its PC in one array operation. Instances that branch apart
+are grouped by PC: every step runs the lowest PC any live instance is waiting at, so the others wait
+at their join point and the groups merge again there. Results match lockstep.functional_steps on
+each input. Registers hold Python integers, unbounded like the scalar model's; dtype=np.int64 runs
+faster but wraps values that outgrow 64 bits.
+"""
+import contextlib
+import copy
+import io
+import time
+import numpy as np
+import component_def as cd
+import Instruction_class as IC
+import lockstep as ls
+
+MEMORY_BYTES = cd.HEAP_BASE   # data memory per instance, from address 0
+MASK32 = 0xFFFFFFFF
+VECTOR_OPS = {
+    "add": lambda a, b, imm: a + b, "sub": lambda a, b, imm: a - b,
+    "xor": lambda a, b, imm: a ^ b, "or": lambda a, b, imm: a | b, "and": lambda a, b, imm: a & b,
+    "sll": lambda a, b, imm: a << (b & 0x1F), "srl": lambda a, b, imm: (a & MASK32) >> (b & 0x1F),
+    "sra": lambda a, b, imm: a >> (b & 0x1F), "slt": lambda a, b, imm: (a < b) * 1,
+    "sltu": lambda a, b, imm: ((a & MASK32) < (b & MASK32)) * 1,
+    "addi": lambda a, b, imm: a + imm, "xori": lambda a, b, imm: a ^ imm,
+    "ori": lambda a, b, imm: a | imm, "andi": lambda a, b, imm: a & imm,
+    "slti": lambda a, b, imm: (a < imm) * 1, "sltiu": lambda a, b, imm: ((a & MASK32) < (imm & MASK32)) * 1,
+    "slli": lambda a, b, imm: a << (imm & 0x1F), "srli": lambda a, b, imm: (a & MASK32) >> (imm & 0x1F),
+    "srai": lambda a, b, imm: a >> (imm & 0x1F),
+}
+BRANCH_TESTS = {
+    "beq": lambda a, b: a == b, "bne": lambda a, b: a != b, "blt": lambda a, b: a < b, "bge": lambda a, b: a >= b,
+    "bltu": lambda a, b: (a & MASK32) < (b & MASK32), "bgeu": lambda a, b: (a & MASK32) >= (b & MASK32),
+}
+
+
+def register_number(name):
+    """10, '10', 'x10' and 'a0' all name register 10."""
+    if isinstance(name, int): return name
+    return int(IC.INV_REG_NAME_MAP.get(name, name[1:] if name.startswith('x') else name))
+
+
+def input_words(imem, data):
+    """The .data words (address -> word) an input starts with: the program's, with its labels' words replaced."""
+    words = dict(imem.data)
+    for key, value in data.items():
+        if key not in imem.data_labels: continue
+        for k, word in enumerate(value if isinstance(value, (list, tuple)) else [value]): words[imem.data_labels[key] + 4 * k] = word
+    return words
+
+
+def initial_state(imem, inputs, memory_bytes=MEMORY_BYTES, dtype=object):
+    """Register (instances x 32) and memory (instances x memory_bytes) arrays, one instance per input.
+
+    An input maps registers ('a0', 'x10' or 10) to values, and .data labels to a word or a list of
+    words stored from the label's address over the program's .data (see input_words).
+    """
+    regs, mem = np.zeros((len(inputs), 32), dtype), np.zeros((len(inputs), memory_bytes), np.uint8)
+    for i, data in enumerate(inputs):
+        for key, value in data.items():
+            if key not in imem.data_labels: regs[i, register_number(key)] = value
+        for address, word in input_words(imem, data).items(): mem[i, address:address + 4] = [(word >> 8 * k) & 0xFF for k in range(4)]
+    regs[:, 0] = 0
+    return regs, mem
+
+
+def _load(mem, rows, address, num_bytes, signed, dtype):
+    value = np.zeros(len(rows), dtype)
+    for k in range(num_bytes): value |= mem[rows, address + k].astype(dtype) << 8 * k
+    if signed:
+        sign = 1 << (8 * num_bytes - 1)
+        value = (value ^ sign) - sign
+    return value
+
+
+def _store(mem, rows, address, value, num_bytes):
+    for k in range(num_bytes): mem[rows, address + k] = (value >> 8 * k) & 0xFF
+
+
+class _InstanceView:
+    """One instance's registers and memory, with the cd.RegisterFile and cd.DataMemory methods
+    a cd.SyscallHandler uses."""
+    def __init__(self, regs, mem, i):
+        self.regs, self.mem, self.rows = regs, mem, np.array([i])
+
+    def read(self, reg_num):
+        return int(self.regs[self.rows[0], int(reg_num)])
+
+    def write(self, reg_num, value):
+        if reg_num is not None and int(reg_num) != 0: self.regs[self.rows[0], int(reg_num)] = value
+
+    def load(self, address, num_bytes, signed):
+        return int(_load(self.mem, self.rows, address, num_bytes, signed, self.regs.dtype)[0])
+
+    def store(self, address, value, num_bytes):
+        _store(self.mem, self.rows, address, value, num_bytes)
+
+
+class BatchResult:
+    """Final state and per-instance traces of a batched run.
+
+    `registers`/`memory` are the final arrays, `steps` the dynamic instruction count of each
+    instance, `exit_codes` the exit status (-1 if the program ran off its end), `truncated` marks
+    instances stopped by the step limit and `syscalls` holds each instance's cd.SyscallHandler.
+    """
+    def __init__(self, registers, memory, steps, exit_codes, truncated, syscalls, branches):
+        self.registers, self.memory, self.steps = registers, memory, steps
+        self.exit_codes, self.truncated, self.syscalls = exit_codes, truncated, syscalls
+        # Conditional branch executions (instance, pc, taken), sorted by instance and in program order within one
+        self.branch_instances, self.branch_pcs, self.branch_taken = branches
+        self._starts = np.searchsorted(self.branch_instances, np.arange(len(steps) + 1))
+
+    def branch_trace(self, i):
+        """Instance `i`'s conditional branches in execution order, as (pc, taken) pairs."""
+        span = slice(self._starts[i], self._starts[i + 1])
+        return list(zip(self.branch_pcs[span].tolist(), self.branch_taken[span].tolist()))
+
+    def branch_sites(self):
+        """Per conditional branch PC: (executions, taken) arrays with one count per instance."""
+        sites, n = {}, len(self.steps)
+        for pc in np.unique(self.branch_pcs).tolist():
+            at = self.branch_pcs == pc
+            sites[pc] = (np.bincount(self.branch_instances[at], minlength=n),
+                         np.bincount(self.branch_instances[at], weights=self.branch_taken[at], minlength=n).astype(np.int64))
+        return sites
+
+
+def run_batch(imem, inputs, memory_bytes=MEMORY_BYTES, max_steps=1_000_000, stdin=b"", dtype=object):
+    """Runs the program from PC 0 once per input (see initial_state) and returns a BatchResult.
+
+    An instance ends at the ecall that exits, when its PC leaves the program, or after `max_steps`
+    instructions (marked truncated). Every instance reads its own copy of `stdin`. Raises
+    IndexError for a memory access outside the `memory_bytes` of data memory.
+    """
+    regs, mem = initial_state(imem, inputs, memory_bytes, dtype)
+    n, end, label_dict = len(inputs), len(imem.instructions) * 4, imem.label_dict
+    pcs, steps = np.zeros(n, np.int64), np.zeros(n, np.int64)
+    exit_codes, truncated = np.full(n, -1, np.int64), np.zeros(n, bool)
+    syscalls = [cd.SyscallHandler(stdin) for _ in range(n)]
+    alu, events = cd.RISCV_ALU(), []
+    # Instances that are done wait at `end`, past every instruction
+    if n and not end: pcs[:] = end
+    while n:
+        pc = int(pcs.min())
+        if pc >= end: break
+        rows = np.flatnonzero(pcs == pc)
+        cols = rows if len(rows) < n else slice(None)
+        instr = imem.instructions[pc // 4]
+        op, imm = instr.op, instr.imm if isinstance(instr.imm, int) else 0
+        rd = instr.get_dest_reg()
+        rd = int(rd) if rd not in (None, '0') else None
+        a = regs[cols, int(instr.rs1)] if instr.rs1 is not None else 0
+        b = regs[cols, int(instr.rs2)] if instr.rs2 is not None else 0
+        next_pc, value = pc + 4, None
+        if op in VECTOR_OPS:
+            value = VECTOR_OPS[op](a, b, imm)
+        elif op in cd.LOAD_OPS or op in cd.STORE_OPS:
+            address, num_bytes = a + imm, ls.ACCESS_BYTES[op]
+            if np.min(address) < 0 or np.max(address) + num_bytes > memory_bytes:
+                raise IndexError(f"{op} at PC {pc:#x} outside the {memory_bytes}-byte data memory")
+            address = np.asarray(address, np.int64)
+            if op in cd.LOAD_OPS: value = _load(mem, rows, address, num_bytes, "u" not in op, dtype)
+            else: _store(mem, rows, address, np.broadcast_to(b, len(rows)), num_bytes)
+        elif op in BRANCH_TESTS:
+            taken = np.broadcast_to(BRANCH_TESTS[op](a, b), len(rows))
+            events.append((rows, pc, taken))
+            next_pc = np.where(taken, label_dict.get(instr.imm), pc + 4)
+        elif op in ("lui", "auipc"):
+            value = alu.execute(instr, pc, 0, 0)
+        elif op == "jal":
+            value, next_pc = pc + 4, label_dict.get(instr.imm)
+        elif op == "jalr":
+            value, next_pc = pc + 4, (a + imm) & ~1
+        elif op == "ecall":
+            for i in rows.tolist():
+                syscalls[i].handle(_InstanceView(regs, mem, i), _InstanceView(regs, mem, i))
+                if syscalls[i].exit_code is not None: exit_codes[i] = syscalls[i].exit_code
+            next_pc = np.where(exit_codes[rows] >= 0, end, pc + 4)
+        elif op not in ("nop", "ebreak"):
+            # Operations without a vector form run one instance at a time on the scalar ALU
+            a, b = np.broadcast_to(a, len(rows)), np.broadcast_to(b, len(rows))
+            value = np.array([alu.execute(instr, pc, int(x), int(y)) for x, y in zip(a, b)], dtype)
+        if rd is not None and value is not None: regs[cols, rd] = value
+        steps[rows] += 1
+        next_pc = np.asarray(next_pc, np.int64)
+        pcs[rows] = np.where((next_pc < 0) | (next_pc >= end), end, next_pc)
+        limited = rows[steps[rows] >= max_steps]
+        if len(limited):
+            truncated[limited] = pcs[limited] < end
+            pcs[limited] = end
+    if events:
+        instances = np.concatenate([rows for rows, _, _ in events])
+        order = np.argsort(instances, kind="stable")
+        branches = (instances[order], np.concatenate([np.full(len(rows), pc) for rows, pc, _ in events])[order],
+                    np.concatenate([taken for _, _, taken in events])[order])
+    else:
+        branches = (np.zeros(0, np.int64), np.zeros(0, np.int64), np.zeros(0, bool))
+    return BatchResult(regs, mem, steps, exit_codes, truncated, syscalls, branches)
+
+
+def compare_speed(instr_list, inputs, memory_bytes=MEMORY_BYTES):
+    """Runs every input through the functional model, one at a time, and as one batch.
+
+    Raises lockstep.DivergenceError if any instance's registers, memory, dynamic instruction count
+    or branch path differs, and returns the two times in seconds.
+    """
+    imem = cd.InstructionMemory()
+    with contextlib.redirect_stdout(io.StringIO()):
+        imem.assemble(instr_list)
+        start = time.perf_counter()
+        result = run_batch(imem, inputs, memory_bytes)
+        batched = time.perf_counter() - start
+        start, references = time.perf_counter(), []
+        for data in inputs:
+            program, rf, dmem = copy.copy(imem), cd.RegisterFile(), cd.DataMemory()
+            program.data = input_words(imem, data)
+            for key, value in data.items():
+                if key not in imem.data_labels: rf.write(register_number(key), value)
+            trace, steps = [], 0
+            for rec in ls.functional_steps(program, rf, dmem):
+                steps += 1
+                if rec.instr.op in BRANCH_TESTS: trace.append((rec.pc, rec.next_pc))
+            references.append((rf, dmem, trace, steps))
+        scalar = time.perf_counter() - start
+    for i, (rf, dmem, trace, steps) in enumerate(references):
+        taken_to = {pc: imem.label_dict.get(imem.instructions[pc // 4].imm) for pc, _ in trace}
+        path = [(pc, taken_to[pc] if taken else pc + 4) for pc, taken in result.branch_trace(i)]
+        row = np.zeros(memory_bytes, np.uint8)
+        for address, byte in dmem.mem.items(): row[address] = byte
+        if ([rf.read(r) for r in range(32)] != result.registers[i].tolist() or not np.array_equal(row, result.memory[i])
+                or path != trace or steps != result.steps[i]):
+            raise ls.DivergenceError(f"Instance {i}: the batched run and the functional model disagree")
+    print(f"{len(inputs)} inputs, {int(result.steps.sum())} instructions: one at a time {scalar:.3f} s, "
+          f"batched {batched:.3f} s ({scalar / batched:.1f}x)")
+    return scalar, batched
+
+
+if __name__ == "__main__":
+    import random
+    import program_gen as pg
+    rng = random.Random(0)
+    for count in (10, 100, 500):
+        inputs = [{"scratch": [rng.randrange(-8, 9) for _ in range(16)]} for _ in range(count)]
+        compare_speed(pg.generate_program(400, seed=1, loop=0.1), inputs)
@@ -0,0 +1,253 @@
+"""Basic-block compilation of an assembled RV32I program for fast architectural (untimed) runs.
+
+Each hot basic block becomes one Python function, generated as straight-line source with the
+registers it touches held in locals and compiled once with compile(). It returns the next PC.
+Blocks are interpreted with the functional model until they have been entered `threshold` times,
+so code that runs only a few times never pays for compilation. Results match
+lockstep.functional_steps instruction for instruction: the expressions are RISCV_ALU's and
+Comparator's, and memory is the same DataMemory, whose load and store compiled blocks inline.
+"""
+import collections
+import contextlib
+import io
+import time
+import component_def as cd
+import lockstep as ls
+
+ALU_EXPRESSIONS = {
+    "add": "{a} + {b}", "sub": "{a} - {b}", "xor": "{a} ^ {b}", "or": "{a} | {b}", "and": "{a} & {b}",
+    "sll": "{a} << ({b} & 0x1F)", "slt": "1 if {a} < {b} else 0",
+    "sltu": "1 if ({a} & 0xFFFFFFFF) < ({b} & 0xFFFFFFFF) else 0",
+    "srl": "({a} & 0xFFFFFFFF) >> ({b} & 0x1F)", "sra": "{a} >> ({b} & 0x1F)",
+    "addi": "{a} + {imm}", "xori": "{a} ^ {imm}", "ori": "{a} | {imm}", "andi": "{a} & {imm}",
+    "slti": "1 if {a} < {imm} else 0", "sltiu": "1 if ({a} & 0xFFFFFFFF) < {imm_u} else 0",
+    "slli": "{a} << {shamt}", "srli": "({a} & 0xFFFFFFFF) >> {shamt}", "srai": "{a} >> {shamt}",
+}
+BRANCH_CONDITIONS = {
+    "beq": "{a} == {b}", "bne": "{a} != {b}", "blt": "{a} < {b}", "bge": "{a} >= {b}",
+    "bltu": "({a} & 0xFFFFFFFF) < ({b} & 0xFFFFFFFF)", "bgeu": "({a} & 0xFFFFFFFF) >= ({b} & 0xFFFFFFFF)",
+}
+# Instructions the runner executes itself instead of compiling
+INTERPRETED_OPS = ["ecall"]
+COMPILE_THRESHOLD = 16   # entries of a block that are interpreted before it is compiled
+CODE_CACHE_SIZE = 4096   # compiled blocks kept across BlockCompilers, keyed by their generated source
+_code_cache = collections.OrderedDict()   # block source -> code object, most recent last
+
+
+class BlockCompiler:
+    """Translates `imem`'s basic blocks once they have been entered `threshold` times and caches their code by entry PC.
+
+    The instruction memory is separate from data memory, so stores never modify code. A program
+    changed in place (re-assembled, rescheduled or patched) must be followed by invalidate().
+    """
+    def __init__(self, imem, threshold=COMPILE_THRESHOLD):
+        self.imem, self.threshold = imem, threshold
+        self.blocks, self.sizes, self.entries, self.decoded, self.compiled = {}, {}, {}, {}, 0
+        self.leaders = self.find_leaders()
+        self.leader_pcs = set(self.leaders)
+        self.alu, self.comparator = cd.RISCV_ALU(), cd.Comparator()
+
+    def invalidate(self, pc=None):
+        """Drops the compiled block containing `pc`, or every block and the block graph if None."""
+        if pc is None:
+            self.blocks, self.sizes, self.entries, self.decoded = {}, {}, {}, {}
+            self.leaders = self.find_leaders()
+            self.leader_pcs = set(self.leaders)
+            return
+        for entry in [e for e, size in self.sizes.items() if e <= pc < e + 4 * size]:
+            del self.blocks[entry], self.sizes[entry]
+        for entry in [e for e, block in self.decoded.items() if e <= pc < e + 4 * len(block)]:
+            del self.decoded[entry]
+
+    def is_block_end(self, instr):
+        return bool(cd.BPUDecoder(instr).is_branch_type) or instr.op in INTERPRETED_OPS
+
+    def find_leaders(self):
+        """Entry PCs of the static basic blocks: the first instruction, every label, and every
+        instruction after a branch, jump or ecall."""
+        instructions = self.imem.instructions
+        leaders = {0} | {pc for pc in self.imem.label_dict.values() if 0 <= pc < len(instructions) * 4}
+        leaders |= {4 * i + 4 for i, instr in enumerate(instructions) if self.is_block_end(instr)}
+        return sorted(pc for pc in leaders if pc < len(instructions) * 4)
+
+    def block_graph(self):
+        """The basic-block graph: entry PC -> (number of instructions, successor PCs).
+
+        An indirect jump's successors are unknown (None) until it runs.
+        """
+        instructions, label_dict, graph = self.imem.instructions, self.imem.label_dict, {}
+        for entry in self.leaders:
+            pc = entry
+            while True:
+                instr = instructions[pc // 4]
+                if self.is_block_end(instr) or pc + 4 in self.leader_pcs or pc + 4 >= len(instructions) * 4: break
+                pc += 4
+            branch_type = cd.BPUDecoder(instr).is_branch_type
+            successors = {1: [label_dict.get(instr.imm), pc + 4], 2: None, 3: [label_dict.get(instr.imm)]}.get(branch_type, [pc + 4])
+            graph[entry] = ((pc - entry) // 4 + 1, successors)
+        return graph
+
+    def translate(self, entry):
+        """Python source of the block starting at `entry`, its instruction count and the register numbers it reads/writes."""
+        instructions, label_dict = self.imem.instructions, self.imem.label_dict
+        lines, read, written, pc, size = [], set(), set(), entry, 0
+
+        def reg(name):
+            if name is None or name == '0': return "0"
+            if name not in written: read.add(name)
+            return f"x{name}"
+
+        def assign(rd, expression):
+            if rd is None or rd == '0': return
+            lines.append(f"x{rd} = {expression}")
+            written.add(rd)
+
+        def exit_to(target):
+            return [f"x[{r}] = x{r}" for r in sorted(written, key=int)] + [f"return {target}"]
+
+        while True:
+            instr = instructions[pc // 4]
+            if instr.op in INTERPRETED_OPS:
+                lines += exit_to(pc)
+                break
+            size += 1
+            op, imm = instr.op, instr.imm if isinstance(instr.imm, int) else 0
+            a, b = reg(instr.rs1), reg(instr.rs2)
+            if op in ALU_EXPRESSIONS:
+                assign(instr.rd, ALU_EXPRESSIONS[op].format(a=a, b=b, imm=imm, imm_u=imm & 0xFFFFFFFF, shamt=imm & 0x1F))
+            elif op in cd.LOAD_OPS:
+                # DataMemory.load and store, inlined on its byte dictionary
+                num_bytes = ls.ACCESS_BYTES[op]
+                if instr.rd != '0':
+                    lines.append(f"address = {a} + {imm}")
+                    assign(instr.rd, " | ".join(f"get(address + {i}, 0) << {8 * i}" for i in range(num_bytes)))
+                    if 'u' not in op: lines.append(f"if x{instr.rd} & {1 << 8 * num_bytes - 1}: x{instr.rd} -= {1 << 8 * num_bytes}")
+            elif op in cd.STORE_OPS:
+                lines += [f"address, value = {a} + {imm}, {b}"]
+                lines += [f"mem[address + {i}] = value >> {8 * i} & 0xFF" for i in range(ls.ACCESS_BYTES[op])]
+            elif op == "lui":
+                assign(instr.rd, imm << 12)
+            elif op == "auipc":
+                assign(instr.rd, pc + (imm << 12))
+            elif op in BRANCH_CONDITIONS:
+                condition = BRANCH_CONDITIONS[op].format(a=a, b=b)
+                lines += [f"if {condition}:"] + ["    " + line for line in exit_to(label_dict.get(instr.imm))] + exit_to(pc + 4)
+                break
+            elif op == "jal":
+                assign(instr.rd, pc + 4)
+                lines += exit_to(label_dict.get(instr.imm))
+                break
+            elif op == "jalr":
+                # The target is computed before the link write, which may overwrite rs1
+                lines.append(f"target = ({a} + {imm}) & ~1")
+                assign(instr.rd, pc + 4)
+                lines += exit_to("target")
+                break
+            elif op not in ("nop", "ebreak"):
+                assign(instr.get_dest_reg(), f"execute(I[{pc // 4}], {pc}, {a}, {b})")
+            pc += 4
+            if pc in self.leader_pcs or pc >= len(instructions) * 4:
+                lines += exit_to(pc)
+                break
+        return lines, size, read
+
+    def compile_block(self, entry):
+        lines, size, read = self.translate(entry)
+        source = "\n".join([f"def block_{entry:x}(x, mem, get):"] + [f"    x{r} = x[{r}]" for r in sorted(read, key=int)]
+                           + ["    " + line for line in lines])
+        namespace = {'I': self.imem.instructions, 'execute': self.alu.execute}
+        # Identical blocks of another run (or another BlockCompiler) reuse the compiled code
+        code = _code_cache.pop(source, None) or compile(source, f"<block 0x{entry:x}>", "exec")
+        _code_cache[source] = code
+        if len(_code_cache) > CODE_CACHE_SIZE: _code_cache.popitem(last=False)
+        exec(code, namespace)
+        self.blocks[entry], self.sizes[entry] = namespace[f"block_{entry:x}"], size
+        self.compiled += 1
+        return self.blocks[entry]
+
+    def decode_block(self, entry):
+        """The block at `entry` for interpret(): (instruction, PC, rs1, rs2, rd) each, with register numbers (0 for none)."""
+        instructions, end, pc, block = self.imem.instructions, len(self.imem.instructions) * 4, entry, []
+        while pc < end and instructions[pc // 4].op not in INTERPRETED_OPS:
+            instr = instructions[pc // 4]
+            block.append((instr, pc, int(instr.rs1 or 0), int(instr.rs2 or 0), int(instr.get_dest_reg() or 0)))
+            pc += 4
+            if self.is_block_end(instr) or pc in self.leader_pcs: break
+        return block
+
+    def interpret(self, entry, x, dmem):
+        """Runs the block at `entry` one instruction at a time on the functional model; returns (next PC, instructions)."""
+        block = self.decoded.get(entry)
+        if block is None: block = self.decoded[entry] = self.decode_block(entry)
+        imem, alu, comparator = self.imem, self.alu, self.comparator
+        for instr, pc, rs1, rs2, rd in block:
+            value, _, next_pc = ls.functional_step(imem, instr, pc, x[rs1], x[rs2], dmem, alu, comparator)
+            if rd: x[rd] = value
+        # Only the last instruction of a block can branch or jump
+        return next_pc, len(block)
+
+    def run(self, rf, dmem, syscalls=None, max_steps=None):
+        """Executes the program on `rf`/`dmem` from PC 0 and returns the number of instructions executed.
+
+        ecalls run on `syscalls` (a cd.SyscallHandler); the program ends at the ecall that exits,
+        or when the PC leaves the program. Stops with RuntimeError after `max_steps` instructions.
+        """
+        syscalls = cd.SyscallHandler() if syscalls is None else syscalls
+        self.imem.load_data(dmem)
+        x = [rf.read(i) for i in range(32)]
+        mem, get, blocks, sizes, entries = dmem.mem, dmem.mem.get, self.blocks, self.sizes, self.entries
+        end, pc, steps = len(self.imem.instructions) * 4, 0, 0
+        while 0 <= pc < end:
+            if self.imem.instructions[pc // 4].op == "ecall":
+                for i in range(1, 32): rf.write(i, x[i])
+                syscalls.handle(rf, dmem)
+                x[10], steps = rf.read(10), steps + 1
+                if syscalls.exit_code is not None: break
+                pc += 4
+                continue
+            block = blocks.get(pc)
+            if block is None and entries.get(pc, 0) < self.threshold:
+                entries[pc] = entries.get(pc, 0) + 1
+                pc, count = self.interpret(pc, x, dmem)
+            else:
+                block = block or self.compile_block(pc)
+                pc, count = block(x, mem, get), sizes[pc]
+            steps += count
+            if max_steps is not None and steps > max_steps:
+                raise RuntimeError(f"Program did not finish within {max_steps} instructions")
+        for i in range(1, 32): rf.write(i, x[i])
+        return steps
+
+
+def compare_speed(instr_list, repeat=7):
+    """Instructions per second of one program: interpreted by the functional model, on the first
+    BlockCompiler run (cold blocks interpreted, hot ones compiled, with no code cached from earlier
+    runs) and on a second run of the same BlockCompiler, when every hot block is already compiled.
+    """
+    imem = cd.InstructionMemory()
+    with contextlib.redirect_stdout(io.StringIO()):
+        imem.assemble(instr_list)
+        timings, reference = {}, None
+        for name in ("interpreted", "first run", "warm"):
+            best = float("inf")
+            for _ in range(repeat):
+                if name == "first run": _code_cache.clear()
+                if name != "warm": compiler = BlockCompiler(imem)
+                rf, dmem, start = cd.RegisterFile(), cd.DataMemory(), time.perf_counter()
+                if name == "interpreted": steps = sum(1 for _ in ls.functional_steps(imem, rf, dmem))
+                else: steps = compiler.run(rf, dmem)
+                best = min(best, time.perf_counter() - start)
+                reference = reference or (steps, rf.reg, dmem.mem)
+                if (steps, rf.reg, dmem.mem) != reference:
+                    raise ls.DivergenceError("Compiled blocks and the functional model disagree")
+            timings[name] = steps / best
+    interpreted, first, warm = timings["interpreted"], timings["first run"], timings["warm"]
+    print(f"{steps} instructions: interpreted {interpreted:,.0f} instr/s, first run {first:,.0f} instr/s "
+          f"({first / interpreted:.1f}x, compilation included), warm {warm:,.0f} instr/s ({warm / interpreted:.1f}x)")
+    return interpreted, first, warm
+
+
+if __name__ == "__main__":
+    import program_gen as pg
+    for length, max_trip in ((400, 8), (400, 64), (1600, 64)):
+        compare_speed(pg.generate_program(length, seed=1, loop=0.1, max_trip=max_trip))
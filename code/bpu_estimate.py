@@ -0,0 +1,235 @@
+"""Static estimate of BPU branch stalls and redirect savings, without running the program.
+
+Every branch site is checked along each incoming control-flow path for the youngest writers of its
+operands, the number of issue slots between them and the branch (producer distance) and whether
+they are loads. A producer `d` slots ahead of a branch in the last fetch stage sits `d - 1` stages
+past it, so the BPU's Stage 1 waits `execute + memory + 1 - d` cycles for a load and
+`execute + 1 - d` for an ALU result (none for one the BPU pre-computes in ID). The estimate is for
+single issue under the "stall" branch policy, without caches or load-use stalls.
+"""
+import collections
+import gc
+import time
+import component_def as cd
+import full_pipeline_risc32i as fp
+
+CONDITIONAL_OPS = frozenset(["beq", "bne", "blt", "bge", "bltu", "bgeu"])
+SITE_OPS = CONDITIONAL_OPS | {"jal", "jalr"}
+# How Stage 1 disposes of a branch site: a jal redirects at once; other sites are resolved in Stage 2
+# a cycle early (as the look-ahead instr2; only a not-taken one then reaches the head of the window
+# and can stall), when they reach the head of the window, or after stalling there
+SITE_CLASSES = ["redirect", "lookahead", "stage2", "stall"]
+# The youngest writer of a branch operand on one incoming path, `kind` "load" or "alu". `sources` are
+# the writers of an ALU producer's own operands, which decide whether the BPU can pre-compute it in ID
+Producer = collections.namedtuple('Producer', ['reg', 'pc', 'distance', 'kind', 'sources'], defaults=((),))
+
+
+def control_flow_graph(imem):
+    """Predecessors of the instructions not simply reached from the one before: pc -> [(predecessor pc, taken edge)].
+
+    Any other instruction's only predecessor is the previous one. Targets of jalr are unknown, so
+    an instruction only reached that way has no predecessors.
+    """
+    instructions, label_dict, joins = imem.instructions, imem.label_dict, {0: []}
+    for i in [i for i, instr in enumerate(instructions) if instr.op in SITE_OPS]:
+        instr = instructions[i]
+        target = label_dict.get(instr.imm) if instr.op != "jalr" else None
+        if target is not None:
+            if target not in joins:
+                joins[target] = [(target - 4, False)] if target and instructions[target // 4 - 1].op not in ("jal", "jalr") else []
+            joins[target].append((4 * i, True))
+        # Nothing falls through past a jump
+        if instr.op in ("jal", "jalr"): joins[4 * i + 4] = [edge for edge in joins.get(4 * i + 4, []) if edge[1]]
+    return joins
+
+
+def profile_from_trace(trace):
+    """Branch-site profile {pc: (executions, taken)} from lockstep.functional_trace records."""
+    profile = collections.defaultdict(lambda: [0, 0])
+    for rec in trace:
+        if rec.instr.op in SITE_OPS:
+            counts = profile[rec.pc]
+            counts[0] += 1
+            counts[1] += rec.next_pc != rec.pc + 4
+    return {pc: tuple(counts) for pc, counts in profile.items()}
+
+
+class StallEstimator:
+    """Producer analysis of `imem`'s branch sites for one pipeline shape (fp.PipelineConfig)."""
+    def __init__(self, imem, pipeline_config=None):
+        self.imem, self.config = imem, pipeline_config or fp.PipelineConfig()
+        self.joins = control_flow_graph(imem)
+        # Producers further back than this are forwardable by the time the branch is examined
+        self.window = self.config.execute + self.config.memory
+        # Stage-1 wait on a producer 0 slots ahead: a load's data leaves MEM, an ALU result leaves EX
+        self.load_wait, self.alu_wait = self.window + 1, self.config.execute + 1
+        self.lookahead, self.via = {}, set()
+        # pc -> operand registers of an ALU producer the BPU can pre-compute in ID
+        self.operands = {}
+
+    def wait(self, producer, shift=0, precompute=True):
+        """Stage-1 wait on `producer` when the branch is examined `shift` slots early.
+
+        Without `precompute`, an ALU producer in ID counts as not pre-computed.
+        """
+        if producer is None: return 0
+        distance = producer.distance - shift
+        if producer.kind == "load": return self.load_wait - distance if distance < self.load_wait else 0
+        # In ID, an ALU result is pre-computed unless its own operands are still in flight
+        if precompute and distance == 1 and not any(self.wait(source, shift) for source in producer.sources): return 0
+        return self.alu_wait - distance if distance < self.alu_wait else 0
+
+    def paths(self, pc, regs):
+        """Every incoming path to the branch at `pc`, as ({reg: Producer or None}, whether it arrives by a taken edge).
+
+        Paths are followed back `window` issue slots. A taken edge costs `fetch` slots, since the
+        BPU drops a resolved branch and its target waits for the fetch stages to refill; a branch
+        resolved by the look-ahead does not take a slot of its own.
+        """
+        instructions, fetch, window, joins, lookahead = self.imem.instructions, self.config.fetch, self.window, self.joins, self.lookahead
+        operand_regs = self.operands
+        wanted, results = set(regs), []
+        # All paths share `found` and `sources`; each walk clears what it added before returning
+        found, sources = {}, {}
+
+        def walk(at, distance, missing, first_taken):
+            # `sources` collects the operand writers of the ALU producers that can be in ID when the
+            # branch, or the look-ahead a slot earlier, is examined; `missing` counts those not found yet
+            added, filled, ended = [], [], True
+            while distance <= window and (len(found) < len(wanted) or missing):
+                instr = instructions[at >> 2]
+                dest = instr.get_dest_reg()
+                if dest is not None and dest != '0':
+                    kind = "load" if instr.op in cd.LOAD_OPS else "alu"
+                    for ops in sources.values():
+                        if ops.get(dest, 0) is None:
+                            ops[dest] = Producer(dest, at, distance, kind)
+                            filled.append((ops, dest))
+                            missing -= 1
+                    if dest in wanted and dest not in found:
+                        found[dest] = Producer(dest, at, distance, kind)
+                        added.append(dest)
+                        if distance <= 2 and kind == "alu" and instr.op not in cd.NO_PRECOMPUTE_OPS:
+                            operands = operand_regs.get(at)
+                            if operands is None: operand_regs[at] = operands = tuple({instr.rs1, instr.rs2} - {None, '0'})
+                            sources[dest] = dict.fromkeys(operands)
+                            missing += len(operands)
+                edges = joins.get(at)
+                if edges is None:
+                    at, distance = at - 4, distance + 1
+                    continue
+                if edges:
+                    ended = False
+                    for pred, taken in edges: step(pred, taken, distance, missing, first_taken)
+                break
+            if ended:
+                producers = dict.fromkeys(regs)
+                for r, p in found.items():
+                    producers[r] = Producer(p.reg, p.pc, p.distance, p.kind, tuple(q for q in sources[r].values() if q)) if r in sources else p
+                results.append((producers, first_taken))
+            for ops, reg in filled: ops[reg] = None
+            for dest in added:
+                del found[dest]
+                sources.pop(dest, None)
+
+        def step(pred, taken, distance, missing, first_taken):
+            if not taken: return walk(pred, distance + 1, missing, first_taken)
+            self.via.add(pred)
+            walk(pred - 4 if lookahead.get(pred) else pred, distance + fetch, missing, first_taken)
+
+        for pred, taken in joins.get(pc, [(pc - 4, False)]): step(pred, taken, 0, 0, taken)
+        return results or [(dict.fromkeys(regs), False)]
+
+    def site(self, pc):
+        """Producer analysis and classification of the branch or jump at `pc`."""
+        instr = self.imem.instructions[pc // 4]
+        if instr.op == "jal":
+            return {'op': "jal", 'class': "redirect", 'paths': [], 'stall_cycles': 0, 'min_stall_cycles': 0, 'lookahead': False}
+        conditional, wait = instr.op in CONDITIONAL_OPS, self.wait
+        regs = [r for r in ([instr.rs1, instr.rs2] if conditional else [instr.rs1]) if r not in (None, '0')]
+        paths, waits, lookahead = [], [], True
+        for found, first_taken in self.paths(pc, regs):
+            producers = found.values()
+            stall = max(map(wait, producers), default=0)
+            # A stalled branch loses the pre-computed result: its producer moves on to EX, where it is in flight
+            if stall: stall = max(wait(p, precompute=False) for p in producers)
+            # The look-ahead resolves the branch as instr2, the cycle before it reaches the head of the
+            # window, if the instruction ahead of it does not write its operands and nothing is in flight.
+            # Taken, it is dropped there; not taken, it is examined again at the head and may still wait.
+            path_lookahead = conditional and not first_taken and all(p is None or p.distance > 1 and not wait(p, 1) for p in producers)
+            paths.append({'producers': found, 'wait': stall, 'lookahead': path_lookahead})
+            waits.append(stall)
+            lookahead = lookahead and path_lookahead
+        site_class = "lookahead" if lookahead else "stall" if max(waits) else "stage2"
+        return {'op': instr.op, 'class': site_class, 'paths': paths, 'stall_cycles': max(waits),
+                'min_stall_cycles': min(waits), 'lookahead': lookahead}
+
+    def sites(self):
+        """Analysis of every branch and jump site: pc -> site() result."""
+        instructions, sites, via = self.imem.instructions, {}, {}
+        pcs = [4 * i for i, instr in enumerate(instructions) if instr.op in SITE_OPS]
+        # A taken edge from a look-ahead branch skips its slot, so every site is classified with full
+        # slots first, then those reached over such an edge once more
+        self.lookahead = {}
+        for pc in pcs:
+            self.via = set()
+            sites[pc], via[pc] = self.site(pc), self.via
+        self.lookahead.update((pc, site['lookahead']) for pc, site in sites.items())
+        for pc in pcs:
+            if any(self.lookahead[v] for v in via[pc]): sites[pc] = self.site(pc)
+        return sites
+
+
+def estimate_stalls(imem, pipeline_config=None, profile=None, verbose=True, pause_gc=False):
+    """Predicts BPU branch-dependency stall cycles and taken-branch cycles saved over an EX-resolved baseline.
+
+    `profile` maps branch PCs to executions or to (executions, taken), e.g. from profile_from_trace;
+    without one every site counts once and conditional branches count as not taken. Each execution
+    is charged its worst incoming path. The baseline loses `fetch + execute` cycles per taken branch
+    (as in lockstep.lockstep_compare); the BPU loses `fetch - 1` (one fewer for a look-ahead branch).
+    With `pause_gc`, the cyclic garbage collector is off during the analysis, which saves a little on
+    large programs but affects every thread of the process.
+    Returns {'sites', 'stall_cycles', 'saved_cycles', 'seconds'}.
+    """
+    start = time.perf_counter()
+    estimator = StallEstimator(imem, pipeline_config)
+    collecting = pause_gc and gc.isenabled()
+    if collecting: gc.disable()
+    try:
+        config, sites = estimator.config, estimator.sites()
+    finally:
+        if collecting: gc.enable()
+    total_stalls = total_saved = 0
+    for pc, site in sites.items():
+        counts = (profile or {}).get(pc, 1 if profile is None else 0)
+        executions, taken = counts if isinstance(counts, tuple) else (counts, counts if site['op'] in ("jal", "jalr") else 0)
+        site['executions'], site['taken'] = executions, taken
+        site['stalls'] = (executions - taken if site['lookahead'] else executions) * site['stall_cycles']
+        site['saved'] = taken * (config.execute + 1 + site['lookahead']) - site['stalls']
+        total_stalls += site['stalls']
+        total_saved += site['saved']
+    seconds = time.perf_counter() - start
+    if verbose:
+        print("\n" + "="*60 + f"\nSTATIC BPU ESTIMATE ({len(fp.stage_names(config))}-stage)\n" + "="*60)
+        by_class = collections.Counter(site['class'] for site in sites.values())
+        print(f"{len(sites)} branch sites: " + ", ".join(f"{by_class[c]} {c}" for c in SITE_CLASSES))
+        for pc, site in sites.items():
+            if site['class'] != "stall": continue
+            worst = max(site['paths'], key=lambda p: p['wait'])
+            producers = ", ".join(f"x{p.reg} from {p.kind} at {p.pc:#x} ({p.distance} ahead)" for p in worst['producers'].values() if p)
+            print(f"  PC {pc:#06x} {site['op']:<5} stalls {site['stall_cycles']} cycle(s) x {site['executions']}: {producers}")
+        print(f"Predicted stall cycles: {total_stalls}, cycles saved vs EX resolution: {total_saved} ({seconds * 1000:.1f} ms)")
+    return {'sites': sites, 'stall_cycles': total_stalls, 'saved_cycles': total_saved, 'seconds': seconds}
+
+
+if __name__ == "__main__":
+    import contextlib
+    import io
+    import lockstep as ls
+    import program_gen as pg
+    imem = cd.InstructionMemory()
+    with contextlib.redirect_stdout(io.StringIO()):
+        imem.assemble(pg.generate_program(400, seed=1, loop=0.1))
+        trace = ls.functional_trace(imem, cd.RegisterFile(), cd.DataMemory())
+    for config in fp.PIPELINES.values():
+        estimate_stalls(imem, config, profile_from_trace(trace))
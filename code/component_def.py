@@ -1,5 +1,10 @@
 import Instruction_class as IC
 import collections
+import copy
+import hashlib
+import os
+import pickle
+import random
 class DataMemory:
     """Simulates the data memory unit with byte-addressable read/write."""
     def __init__(self):
@@ -47,6 +52,88 @@ class DataMemory:
                 print(f"Mem[0x{address:08X}] = 0x{word_val & 0xFFFFFFFF:08X}")
         print("="*57)
 
+REPLACEMENT_POLICIES = ["lru", "random"]
+class Cache:
+    """Set-associative cache timing model: only tags are kept, the data stays in the backing memory.
+
+    Latencies count the whole access in cycles, so a 1-cycle hit costs the pipeline nothing extra.
+    Misses allocate the line (stores included); the simulator keeps `cycle` current so that a hit
+    on a line whose fill is still in flight waits for the fill.
+    """
+    def __init__(self, name, size=1024, ways=2, line_size=16, replacement="lru", hit_latency=1, miss_latency=10, seed=0):
+        if replacement not in REPLACEMENT_POLICIES: raise ValueError(f"Unknown replacement policy '{replacement}'")
+        if size % (ways * line_size): raise ValueError("Cache size must be a multiple of ways * line_size")
+        self.name, self.ways, self.line_size, self.replacement = name, ways, line_size, replacement
+        self.hit_latency, self.miss_latency = hit_latency, miss_latency
+        self.num_sets = size // (ways * line_size)
+        self.sets = [[] for _ in range(self.num_sets)]   # tags per set, least recently used first
+        self.rng = random.Random(seed)
+        self.hits, self.misses = 0, 0
+        self.cycle, self.fill_ready = 0, {}   # line -> cycle its fill completes
+
+    def access(self, address):
+        """Looks up `address`, filling its line on a miss, and returns the access latency."""
+        line = address // self.line_size
+        tags, tag = self.sets[line % self.num_sets], line // self.num_sets
+        if tag in tags:
+            self.hits += 1
+            if self.replacement == "lru": tags.remove(tag); tags.append(tag)
+            return max(self.hit_latency, self.fill_ready.get(line, 0) - self.cycle)
+        self.misses += 1
+        if len(tags) == self.ways:
+            victim = tags.pop(0 if self.replacement == "lru" else self.rng.randrange(self.ways))
+            self.fill_ready.pop(victim * self.num_sets + line % self.num_sets, None)
+        tags.append(tag)
+        self.fill_ready[line] = self.cycle + self.miss_latency
+        return self.miss_latency
+
+    def stats(self):
+        accesses = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / accesses if accesses else 0.0}
+
+# RISC-V Linux system call numbers (a7); newlib's sbrk is built on brk
+SYSCALLS = {63: "read", 64: "write", 93: "exit", 94: "exit_group", 214: "brk"}
+HEAP_BASE = 0x10000          # initial program break, above the .data section
+EBADF, ENOSYS = -9, -38
+class SyscallHandler:
+    """Emulates the system calls an ecall makes: number in a7, arguments in a0-a2, result in a0.
+
+    Console output is collected in `stdout`/`stderr`; read() consumes the `stdin` bytes given.
+    After exit, `exit_code` holds the status (low 8 bits of a0) and the simulation stops.
+    """
+    def __init__(self, stdin=b"", heap_base=HEAP_BASE):
+        self.stdin, self.stdout, self.stderr = bytes(stdin), bytearray(), bytearray()
+        self.brk, self.heap_base, self.exit_code, self.calls = heap_base, heap_base, None, 0
+
+    def handle(self, rf, dmem):
+        number, a0, a1, a2 = (rf.read(reg) for reg in ('17', '10', '11', '12'))
+        name = SYSCALLS.get(number)
+        self.calls += 1
+        if name in ("exit", "exit_group"):
+            self.exit_code = a0 & 0xFF
+            print(f"    [SYSCALL] {name}({a0})")
+            return
+        if name == "write":
+            out = {1: self.stdout, 2: self.stderr}.get(a0)
+            data = bytes(dmem.load(a1 + i, 1, False) for i in range(a2)) if out is not None else b""
+            if out is not None: out.extend(data)
+            result = a2 if out is not None else EBADF
+            print(f"    [SYSCALL] write(fd={a0}, {a2} bytes) = {result}: {data!r}")
+        elif name == "read":
+            data, self.stdin = (self.stdin[:a2], self.stdin[a2:]) if a0 == 0 else (b"", self.stdin)
+            for i, byte in enumerate(data): dmem.store(a1 + i, byte, 1)
+            result = len(data) if a0 == 0 else EBADF
+            print(f"    [SYSCALL] read(fd={a0}, {a2} bytes) = {result}")
+        elif name == "brk":
+            # brk(0) queries the break; a request below the heap start leaves it unchanged
+            if a0 >= self.heap_base: self.brk = a0
+            result = self.brk
+            print(f"    [SYSCALL] brk(0x{a0:X}) = 0x{result:X}")
+        else:
+            result = ENOSYS
+            print(f"    [SYSCALL] unknown system call {number}")
+        rf.write('10', result)
+
 class RegisterFile:
     """Simulates the RISC-V 32-register file."""
     def __init__(self):
@@ -96,9 +183,52 @@ class BPUDecoder:
         if self.op in ["beq", "bne", "blt", "bge", "bltu", "bgeu"]: self.is_branch_type = 1
         elif self.op in ["jalr"]: self.is_branch_type = 2
         elif self.op in ["jal"]: self.is_branch_type = 3
-# --- BPU MANAGER CLASS (UNCHANGED CORE LOGIC) ---
+PREDICTORS = ["not-taken", "btfn", "bimodal"]
+class BranchPredictor:
+    """Predicts the next PC for a branch the BPU cannot resolve yet (used only while speculating)."""
+    def __init__(self, scheme="not-taken", entries=64):
+        if scheme not in PREDICTORS: raise ValueError(f"Unknown predictor '{scheme}'")
+        self.scheme, self.entries = scheme, entries
+        self.counters = [1] * entries   # 2-bit saturating counters, >= 2 predicts taken
+        self.targets = {}               # last resolved jalr target per PC (bimodal only)
+
+    def predict(self, instr, bta):
+        """Returns the predicted next PC, or None when there is nothing worth speculating on."""
+        if instr.op == 'jalr': return self.targets.get(instr.pc) if self.scheme == "bimodal" else None
+        if self.scheme == "not-taken": taken = False
+        elif self.scheme == "btfn": taken = bta <= instr.pc
+        else: taken = self.counters[(instr.pc >> 2) % self.entries] >= 2
+        return bta if taken else instr.pc + 4
+
+    def update(self, instr, next_pc):
+        if instr.op == 'jalr': self.targets[instr.pc] = next_pc; return
+        idx = (instr.pc >> 2) % self.entries
+        self.counters[idx] = min(3, self.counters[idx] + 1) if next_pc != instr.pc + 4 else max(0, self.counters[idx] - 1)
+
+# --- BPU MANAGER CLASS ---
+LOAD_OPS = ["lb", "lh", "lw", "lbu", "lhu"]
+STORE_OPS = ["sb", "sh", "sw"]
+# How a branch waiting on an in-flight load is handled: freeze fetch, fetch down the fall-through
+# path ("late"), or fetch down the path chosen by a BranchPredictor ("speculate").
+BRANCH_POLICIES = ["stall", "late", "speculate"]
+# BPU hardware events counted in BranchPrecomputationUnit.activity: Stage-1 decodes, BTA adder,
+# comparator, register-file read ports and main-ALU pre-computations in ID
+BPU_EVENTS = ["decode", "bta", "compare", "rf_read", "precompute"]
+# Instructions whose result the BPU's main ALU cannot pre-compute in ID
+NO_PRECOMPUTE_OPS = LOAD_OPS + STORE_OPS + [
+    "beq", "bne", "blt", "bge", "bltu", "bgeu", # Branches (a jump's link value, pc+4, can be pre-computed)
+    "ecall", "ebreak", "nop"]
+
+def operand_wait(use_regs, producers):
+    """Cycles until every reg in `use_regs` is forwardable, given (reg, cycles) for in-flight writers, youngest first."""
+    wait = 0
+    for reg in use_regs:
+        wait = max(wait, next((cycles for dest, cycles in producers if dest == reg), 0))
+    return wait
+
 class BranchPrecomputationUnit:
-    def __init__(self, imem,alu):
+    def __init__(self, imem,alu, branch_policy="stall", predictor="not-taken", icache=None):
+        if branch_policy not in BRANCH_POLICIES: raise ValueError(f"Unknown branch policy '{branch_policy}'")
         self.imem = imem
         self.main_alu =alu            # The powerful ALU for pre-computing results
         self.alu = MinimalALU()         # The simple ALU for BTA calculation
@@ -106,160 +236,507 @@ class BranchPrecomputationUnit:
         self.stage2_input = {'enable': False, 'branches': []}
         self.final_directive = IC.Directive(False, 0)
         self.system_stall_request, self.last_checked_pc = False, None
-        self.forwarding_id_ex, self.forwarding_ex_mem, self.forwarding_mem_wb = None, None, None
+        # Forwarding paths set by the simulator: one {'reg', 'val', 'instr_op', 'tag'} entry per writer, youngest first
+        self.forwarding_id_ex, self.forwarding_ex_mem, self.forwarding_mem_wb = [], [], []
+        self.instr2_resolved = False   # instr2 was a branch that Stage 2 resolved not taken this cycle
+        # A load-dependent branch waits here while fetch runs down the predicted path; instructions
+        # fetched meanwhile carry its tag and are squashed (squash_tag) if the prediction was wrong.
+        self.branch_policy, self.pending_branch, self.squash_tag, self.spec_tag = branch_policy, None, None, 0
+        self.predictor = BranchPredictor(predictor if branch_policy == "speculate" else "not-taken")
+        self.late_resolved, self.late_flushes = 0, 0
+        # With an I-cache the look-ahead slot (pc+4) costs its own access whenever it lies in the next
+        # line; that access takes the fetch port for the cycle (icache_port_used)
+        self.icache, self.icache_port_used, self.icache_accesses = icache, False, 0
+        self.activity = collections.Counter({event: 0 for event in BPU_EVENTS})
+
+    def _forwarded_value(self, reg, default, use_id_fwd=True, skip_tag=None):
+        """Youngest in-flight value of `reg` (ID precompute, EX/MEM, MEM/WB), else `default`.
+
+        Writers tagged `skip_tag` were fetched behind an unresolved branch and are ignored.
+        """
+        if reg is None or reg == '0': return 0
+        if use_id_fwd:
+            for fwd in self.forwarding_id_ex:
+                if fwd['reg'] == reg: return fwd['val']
+        for fwd in self.forwarding_ex_mem:
+            if fwd['reg'] == reg and fwd['instr_op'] not in LOAD_OPS and (skip_tag is None or fwd['tag'] != skip_tag): return fwd['val']
+        for fwd in self.forwarding_mem_wb:
+            if fwd['reg'] == reg and (skip_tag is None or fwd['tag'] != skip_tag): return fwd['val']
+        return default
+
+    def _read(self, rf, reg):
+        """Register-file read through a BPU read port (x0 is hard-wired and costs none)."""
+        if reg is not None and reg != '0': self.activity['rf_read'] += 1
+        return rf.read(reg)
+
+    def _compute_bta(self, instr, label):
+        self.activity['bta'] += 1
+        return self.alu.compute_bta(instr.pc, self.imem.label_dict.get(label) - instr.pc)
+
+    def _is_taken(self, op, val1, val2):
+        self.activity['compare'] += 1
+        return self.comparator.is_taken(op, val1, val2)
+
     def _precompute_id_stage_result(self, instr):
-        if not instr or instr.op in [
-            "lb", "lh", "lw", "lbu", "lhu",        # Loads
-            "sb", "sh", "sw",                      # Stores
-            "beq", "bne", "blt", "bge", "bltu", "bgeu", # Branches
-            "jal", "jalr",                         # Jumps
-            "ecall", "ebreak", "nop"]: return None
+        if not instr or instr.op in NO_PRECOMPUTE_OPS: return None
         dest_reg = instr.get_dest_reg()
         if not dest_reg or dest_reg == '0': return None
-        result = self.main_alu.execute(instr, instr.pc, instr.rs1_val, instr.rs2_val)
+        # Operands read in ID may still be in flight; apply the same forwarding EX will
+        rs1_val = self._forwarded_value(instr.rs1, instr.rs1_val, use_id_fwd=False)
+        rs2_val = self._forwarded_value(instr.rs2, instr.rs2_val, use_id_fwd=False)
+        # Kept on the instruction so the early EX stages of a deeper pipeline can forward it too
+        result = instr.result = self.main_alu.execute(instr, instr.pc, rs1_val, rs2_val)
+        self.activity['precompute'] += 1
         print(f"    [BPU ID-FWD] Pre-computing result for '{instr.op}' (PC={instr.pc:#x}): reg {dest_reg} = {result}")
-        return {'reg': dest_reg, 'val': result}
+        return {'reg': dest_reg, 'val': result, 'tag': instr.spec_tag}
 
+    @staticmethod
+    def _link_flush(jump):
+        """Directive flush for a taken instr1: a jump that writes a link register still issues."""
+        return 0 if jump.get_dest_reg() not in (None, '0') else 1
 
-    def run_bpu_cycle(self, pc, id_stage_instr, ex_stage_instr, rf):
-        # Reset outputs at the start of every cycle
+    def skip_cycle(self, rf):
+        """Called for cycles in which the front end holds and the BPU does not examine fetch.
+
+        The loads a pending branch waits on still advance, and it still resolves once their data
+        arrives: returns True if it was mispredicted (final_directive and squash_tag are then set).
+        """
+        self._reset_outputs()
+        return bool(self.pending_branch) and self._redirect_late(rf)
+
+    def _reset_outputs(self):
         self.final_directive = IC.Directive(False, 0)
-        self.system_stall_request = False
-        if self.last_checked_pc == pc:
+        self.system_stall_request, self.squash_tag, self.instr2_resolved = False, None, False
+        self.icache_port_used = False
+
+    def _redirect_late(self, rf):
+        late_result = self._resolve_pending_branch(rf)
+        if not late_result: return False
+        self.final_directive = IC.Directive(True, late_result['bta'])
+        self.squash_tag = late_result['tag']
+        self.stage2_input = {'enable': False, 'branches': []}
+        self.last_checked_pc = None
+        return True
+
+    def _resolve_pending_branch(self, rf):
+        pending = self.pending_branch
+        pending['wait'] -= 1
+        if pending['wait'] > 0: return None
+        self.pending_branch = None
+        instr, decoded = pending['instr'], BPUDecoder(pending['instr'])
+        # The branch has left IF, so the ID-stage precompute and anything carrying its tag are younger
+        val1 = self._forwarded_value(decoded.rs1, self._read(rf, decoded.rs1), use_id_fwd=False, skip_tag=pending['tag'])
+        val2 = self._forwarded_value(decoded.rs2, self._read(rf, decoded.rs2), use_id_fwd=False, skip_tag=pending['tag'])
+        if decoded.op == 'jalr': next_pc = (val1 + (decoded.imm or 0)) & ~1
+        else: next_pc = pending['bta'] if self._is_taken(decoded.op, val1, val2) else instr.pc + 4
+        self.predictor.update(instr, next_pc)
+        self.late_resolved += 1
+        if next_pc == pending['predicted_pc']:
+            print(f"    [BPU LATE] {instr.op} at PC {instr.pc:#x} resolved to 0x{next_pc:X} as predicted"); return None
+        self.late_flushes += 1
+        print(f"    [BPU LATE] {instr.op} at PC {instr.pc:#x} resolved to 0x{next_pc:X}, mispredicted 0x{pending['predicted_pc']:X}")
+        return {'taken': True, 'bta': next_pc, 'tag': pending['tag']}
+
+    def run_bpu_cycle(self, pc, id_stage_instrs, producers, rf):
+        """One BPU cycle for the fetch group at `pc` (None if that stage is empty).
+
+        `id_stage_instrs` is the group leaving ID; `producers` lists (reg, cycles until forwardable)
+        for every in-flight writer from ID onwards, youngest first.
+        """
+        # Reset outputs at the start of every cycle
+        self._reset_outputs()
+        if self.pending_branch and self._redirect_late(rf): return
+        if pc is not None and self.last_checked_pc == pc:
             s1_result = self.stage2_input 
         else:
-            s1_result = self._run_bpu_stage1(pc, id_stage_instr, ex_stage_instr, rf)
+            s1_result = self._run_bpu_stage1(pc, producers, rf)
         
         self.last_checked_pc = pc
         if s1_result.get('stall'):
             self.system_stall_request = True
             self.stage2_input = {'branches': s1_result.get('branches', [])}
             return
+        # The ID group advances this cycle; a pending branch may be waiting on its results
+        self.forwarding_id_ex = [r for r in map(self._precompute_id_stage_result, reversed(id_stage_instrs)) if r]
+        if s1_result.get('pending'):
+            # Fetch follows the prediction; the branch is re-checked once the load data arrives
+            pending = self.pending_branch = s1_result['pending']
+            self.spec_tag += 1
+            pending['tag'] = self.spec_tag
+            print(f"    [BPU S1] {pending['instr'].op} at PC {pending['instr'].pc:#x} waits {pending['wait']} cycle(s) for load data, predicting 0x{pending['predicted_pc']:X}")
+            self.stage2_input = {'enable': False, 'branches': []}
+            if pending['predicted_pc'] != pending['instr'].pc + 4:
+                self.final_directive = IC.Directive(True, pending['predicted_pc'], self._link_flush(pending['instr']))
+            return
         if s1_result.get('taken'):
-            self.final_directive = IC.Directive(True, s1_result['bta'])
+            self.final_directive = IC.Directive(True, s1_result['bta'], s1_result['flush'])
             self.stage2_input = {'enable': False, 'branches': []} # Clear any old state
             return
-        self.forwarding_id_ex = self._precompute_id_stage_result(id_stage_instr)
         branches_to_check = s1_result.get('branches', [])
         s2_result = self._run_bpu_stage2(rf, branches_to_check)
 
         # If Stage 2 resolved a branch as TAKEN, we are done for this cycle.
         if s2_result and s2_result.get('taken'):
-            self.final_directive = IC.Directive(True, s2_result['bta'])
+            self.final_directive = IC.Directive(True, s2_result['bta'], s2_result['flush'])
             self.stage2_input = {'enable': False, 'branches': []}
             return
         self.final_directive = IC.Directive(False, 0)
         self.stage2_input = {'branches': branches_to_check}
+        self.instr2_resolved = any(b['flush'] == 0 for b in branches_to_check)
 
 
-    def _run_bpu_stage1(self, pc, id_stage_instr, ex_stage_instr, rf):
+    def _run_bpu_stage1(self, pc, producers, rf):
+        if pc is None: return {}
         instr1 = self.imem.instructions[pc // 4] if pc < len(self.imem.instructions) * 4 else None
         instr2 = self.imem.instructions[(pc + 4) // 4] if (pc + 4) < len(self.imem.instructions) * 4 else None
+        if instr2 and self.icache and (pc + 4) // self.icache.line_size != pc // self.icache.line_size:
+            self.icache_port_used = True
+            self.icache_accesses += 1
+            if self.icache.access(pc + 4) > self.icache.hit_latency: instr2 = None   # line still being filled
         print(f"    [BPU S1] instr1.pc={getattr(instr1, 'pc', None)}, instr2.pc={getattr(instr2, 'pc', None)}")
         if not instr1: return {}
         decoded1, decoded2, branches = BPUDecoder(instr1), BPUDecoder(instr2), []
-        if decoded1.is_branch_type == 3: return {'taken': True, 'bta': self.imem.label_dict.get(decoded1.imm)}
+        self.activity['decode'] += 1 + bool(instr2)   # later stages reuse these decodes
+        if decoded1.is_branch_type == 3: return {'taken': True, 'bta': self._compute_bta(instr1, decoded1.imm), 'flush': self._link_flush(instr1)}
         if decoded1.op == 'jalr' or decoded1.is_branch_type == 1:
             use_regs = [decoded1.rs1, decoded1.rs2] if decoded1.is_branch_type == 1 else [decoded1.rs1]
-            if any(id_stage_instr and id_stage_instr.op == 'lw' and id_stage_instr.get_dest_reg() == r for r in use_regs) or \
-               any(ex_stage_instr and ex_stage_instr.op == 'lw' and ex_stage_instr.get_dest_reg() == r for r in use_regs):
-                return {'stall': True}
-            bta = self.alu.compute_bta(instr1.pc, self.imem.label_dict.get(decoded1.imm) - instr1.pc) if decoded1.is_branch_type == 1 else 0
-            branches.append({'instr': instr1, 'bta': bta})
+            bta = self._compute_bta(instr1, decoded1.imm) if decoded1.is_branch_type == 1 else 0
+            wait = operand_wait(use_regs, producers)
+            if wait:
+                # One branch is speculated at a time; jalr without a predicted target always stalls
+                predicted_pc = self.predictor.predict(instr1, bta) if self.branch_policy != "stall" and not self.pending_branch else None
+                if predicted_pc is None: return {'stall': True}
+                return {'pending': {'instr': instr1, 'bta': bta, 'wait': wait, 'predicted_pc': predicted_pc}}
+            branches.append({'instr': instr1, 'bta': bta, 'flush': 1})
         if instr2 and decoded2.is_branch_type == 1:
-            i1_dest = instr1.get_dest_reg()
-            if i1_dest and i1_dest in [decoded2.rs1, decoded2.rs2] and instr1.op == 'lw': return {'stall': True}
-            bta2 = self.alu.compute_bta(instr2.pc, self.imem.label_dict.get(decoded2.imm) - instr2.pc)
-            branches.append({'instr': instr2, 'bta': bta2})
+            # Only resolve instr2 early when none of its operands is produced by instr1 or still in flight;
+            # otherwise it is simply re-examined as instr1 next cycle.
+            use_regs2 = [decoded2.rs1, decoded2.rs2]
+            if instr1.get_dest_reg() not in use_regs2 and not operand_wait(use_regs2, producers):
+                bta2 = self._compute_bta(instr2, decoded2.imm)
+                branches.append({'instr': instr2, 'bta': bta2, 'flush': 0})   # instr1 still proceeds to ID
         return {'bpu_stage_2_en': True, 'branches': branches} if branches else {}
 
-    def _run_bpu_stage2(self, rf, branches_to_check): # <-- Added 'branches_to_check' argument
-        # The 'if not self.stage2_input...' line is REMOVED.
-        
-        def get_value(reg):
-            # (This inner function does not change at all)
-            if reg is None or reg == '0': return 0
-            if self.forwarding_id_ex and self.forwarding_id_ex.get('reg') == reg: return self.forwarding_id_ex['val']
-            if self.forwarding_ex_mem and self.forwarding_ex_mem.get('reg') == reg and 'lw' not in (self.forwarding_ex_mem.get('instr_op') or ""): return self.forwarding_ex_mem['val']
-            if self.forwarding_mem_wb and self.forwarding_mem_wb.get('reg') == reg: return self.forwarding_mem_wb['val']
-            return rf.read(reg) or 0
-            
-        for branch in branches_to_check: # <-- Use the new argument here
+    def _run_bpu_stage2(self, rf, branches_to_check):
+        def get_value(reg): return self._forwarded_value(reg, self._read(rf, reg) or 0)
+
+        for branch in branches_to_check:
             instr, bta, decoded = branch['instr'], branch['bta'], BPUDecoder(branch['instr'])
             if decoded.op == 'jalr':
                 target = (get_value(decoded.rs1) + (decoded.imm or 0)) & ~1
-                print(f"    [BPU S2] JALR at PC {instr.pc:#08x} resolved to 0x{target:X}"); return {'taken': True, 'bta': target}
+                self.predictor.update(instr, target)
+                print(f"    [BPU S2] JALR at PC {instr.pc:#08x} resolved to 0x{target:X}"); return {'taken': True, 'bta': target, 'flush': self._link_flush(instr)}
             val1, val2 = get_value(decoded.rs1), get_value(decoded.rs2)
-            if self.comparator.is_taken(decoded.op, val1, val2):
-                print(f"    [BPU S2] Branch {instr.op} resolved as TAKEN"); return {'taken': True, 'bta': bta}
+            taken = self._is_taken(decoded.op, val1, val2)
+            if branch['flush']: self.predictor.update(instr, bta if taken else instr.pc + 4)   # instr2 is re-seen next cycle
+            if taken:
+                print(f"    [BPU S2] Branch {instr.op} resolved as TAKEN"); return {'taken': True, 'bta': bta, 'flush': branch['flush']}
             print(f"    [BPU S2] Branch {instr.op} resolved as NOT TAKEN")
         return None
 
 # --- MAIN SIMULATOR COMPONENTS ---
+# --- ASSEMBLER TABLES ---
+# Operand syntax per format: register fields, `imm` (number or %hi/%lo(symbol)), `mem` (imm(rs1)) and `label`
+OPERAND_FORMATS = {
+    "R": ("rd", "rs1", "rs2"), "I": ("rd", "rs1", "imm"), "L": ("rd", "mem"), "S": ("rs2", "mem"),
+    "B": ("rs1", "rs2", "label"), "U": ("rd", "imm"), "J": ("rd", "label"), "JR": ("rd", "rs1", "imm"), "N": (),
+}
+OPCODE_FORMATS = {
+    **dict.fromkeys(["add", "sub", "xor", "or", "and", "sll", "slt", "sltu", "srl", "sra"], "R"),
+    **dict.fromkeys(["addi", "xori", "ori", "andi", "slti", "sltiu", "slli", "srli", "srai"], "I"),
+    **dict.fromkeys(LOAD_OPS, "L"), **dict.fromkeys(STORE_OPS, "S"),
+    **dict.fromkeys(["beq", "bne", "blt", "bge", "bltu", "bgeu"], "B"),
+    **dict.fromkeys(["lui", "auipc"], "U"), "jal": "J", "jalr": "JR",
+    **dict.fromkeys(["nop", "ecall", "ebreak"], "N"),
+}
+def _li(rd, value):
+    value = int(value, 0)
+    lo = ((value & 0xFFF) ^ 0x800) - 0x800
+    if lo == value: return [("addi", [rd, "x0", str(value)])]
+    return [("lui", [rd, str((value - lo) >> 12)])] + ([("addi", [rd, rd, str(lo)])] if lo else [])
+# Pseudo-instructions: name -> (operand count, expansion into base instructions)
+PSEUDO_INSTRUCTIONS = {
+    "li": (2, _li),
+    "la": (2, lambda rd, sym: [("lui", [rd, f"%hi({sym})"]), ("addi", [rd, rd, f"%lo({sym})"])]),
+    "mv": (2, lambda rd, rs: [("addi", [rd, rs, "0"])]),
+    "not": (2, lambda rd, rs: [("xori", [rd, rs, "-1"])]),
+    "neg": (2, lambda rd, rs: [("sub", [rd, "x0", rs])]),
+    "seqz": (2, lambda rd, rs: [("sltiu", [rd, rs, "1"])]),
+    "snez": (2, lambda rd, rs: [("sltu", [rd, "x0", rs])]),
+    "sltz": (2, lambda rd, rs: [("slt", [rd, rs, "x0"])]),
+    "sgtz": (2, lambda rd, rs: [("slt", [rd, "x0", rs])]),
+    "beqz": (2, lambda rs, label: [("beq", [rs, "x0", label])]),
+    "bnez": (2, lambda rs, label: [("bne", [rs, "x0", label])]),
+    "blez": (2, lambda rs, label: [("bge", ["x0", rs, label])]),
+    "bgez": (2, lambda rs, label: [("bge", [rs, "x0", label])]),
+    "bltz": (2, lambda rs, label: [("blt", [rs, "x0", label])]),
+    "bgtz": (2, lambda rs, label: [("blt", ["x0", rs, label])]),
+    "bgt": (3, lambda rs, rt, label: [("blt", [rt, rs, label])]),
+    "ble": (3, lambda rs, rt, label: [("bge", [rt, rs, label])]),
+    "bgtu": (3, lambda rs, rt, label: [("bltu", [rt, rs, label])]),
+    "bleu": (3, lambda rs, rt, label: [("bgeu", [rt, rs, label])]),
+    "j": (1, lambda label: [("jal", ["x0", label])]),
+    "jr": (1, lambda rs: [("jalr", ["x0", rs, "0"])]),
+    "ret": (0, lambda: [("jalr", ["x0", "ra", "0"])]),
+    "call": (1, lambda label: [("jal", ["ra", label])]),
+    "tail": (1, lambda label: [("jal", ["x0", label])]),
+}
+DATA_BASE = 0x1000            # first address of the .data section
+ASSEMBLER_VERSION = 2         # part of the cache key; bump when the output format changes
+_assembly_cache = collections.OrderedDict()   # source hash -> assembled program, most recent last
+ASSEMBLY_CACHE_SIZE = 32
+
+class AssemblyError(ValueError):
+    """An assembly source error, reported with its line number."""
+    def __init__(self, line_no, message, line):
+        super().__init__(f"line {line_no}: {message}: '{line}'")
+        self.line_no = line_no
+
 class InstructionMemory:
-    """Parses RISC-V assembly and stores instructions."""
+    """Assembles RISC-V source (with pseudo-instructions and a .data section) and stores the instructions."""
     def __init__(self):
         self.instructions, self.label_dict = [], {}
+        self.data_labels, self.data = {}, {}   # .data symbols -> address, and the initial words by address
 
-    def assemble(self, instr_strings):
-        def get_reg_num(s): return IC.INV_REG_NAME_MAP.get(s, s.replace('x', ''))
-        pc, temp_instr = 0, []
-        for line in instr_strings:
-            line = line.strip().split('#')[0].strip()
-            if ':' in line: label, rest = line.split(':', 1); self.label_dict[label.strip()] = pc; line = rest.strip()
-            if not line: continue
-            temp_instr.append((line, pc)); pc += 4
-            
-        for line, pc_val in temp_instr:
-            # --- FIX IS HERE ---
-            # We no longer replace the comma globally. We split into opcode and the rest.
-            parts = [p.strip() for p in line.split(maxsplit=1)]
-            opcode = parts[0].lower()
-            operands_str = parts[1] if len(parts) > 1 else ""
-            
-            # Now, we split the operands string by the comma. This is more robust.
-            operands = [p.strip() for p in operands_str.split(',')]
-            
-            instr = IC.Instruction(op=opcode, pc=pc_val)
-            
-            if opcode in ["add","sub","xor","or","and","sll","slt","sltu","srl","sra"]: instr.rd, instr.rs1, instr.rs2 = map(get_reg_num, operands)
-            elif opcode in ["addi","xori","ori","andi","slti","sltiu","slli","srli","srai"]: instr.rd, instr.rs1, instr.imm = get_reg_num(operands[0]), get_reg_num(operands[1]), int(operands[2], 0)
-            elif opcode in ["lb", "lh", "lw", "lbu", "lhu"]: instr.rd, mem_operand = get_reg_num(operands[0]), operands[1]; mem_parts = mem_operand.replace(')','').split('('); instr.imm, instr.rs1 = int(mem_parts[0]), get_reg_num(mem_parts[1])
-            elif opcode == "jalr": instr.rd, instr.rs1 = get_reg_num(operands[0]), get_reg_num(operands[1]); instr.imm = int(operands[2], 0) if len(operands) > 2 else 0
-            elif opcode in ["sb", "sh", "sw"]: instr.rs2, mem_operand = get_reg_num(operands[0]), operands[1]; mem_parts = mem_operand.replace(')','').split('('); instr.imm, instr.rs1 = int(mem_parts[0]), get_reg_num(mem_parts[1])
-            elif opcode in ["beq","bne","blt","bge","bltu","bgeu"]: instr.rs1, instr.rs2, instr.imm = get_reg_num(operands[0]), get_reg_num(operands[1]), operands[2]
-            elif opcode in ["lui", "auipc"]: instr.rd, instr.imm = get_reg_num(operands[0]), int(operands[1], 0)
-            elif opcode == "jal": instr.rd, instr.imm = get_reg_num(operands[0]), operands[1]
-            elif opcode in ["nop", "ecall", "ebreak"]: pass
-            
-            self.instructions.append(instr)
+    SCHEDULE_GAP = 2   # instructions wanted between a branch and its operand producer (a load's latency to MEM/WB)
+
+    def assemble(self, instr_strings, schedule=False, cache_dir=None):
+        """Assembles an iterable of source lines (or one string) line by line.
+
+        `schedule` runs the branch-aware scheduling pass. Results are cached by source hash in memory
+        and, with `cache_dir`, on disk for later runs. Raises AssemblyError on bad input.
+        """
+        if isinstance(instr_strings, str): instr_strings = instr_strings.split('\n')
+        digest, key = hashlib.sha256(), None
+        if isinstance(instr_strings, (list, tuple)):
+            for line in instr_strings: digest.update(line.encode() + b'\n')
+            key = self._cache_key(digest, schedule)
+            if self._load_cached(key, cache_dir): return self.instructions, self.label_dict
+        else:
+            # Streamed input is hashed as it is read, so it can only populate the cache
+            instr_strings = self._hashed(instr_strings, digest)
+        self._assemble_lines(instr_strings)
+        if schedule: self.schedule_branches()
+        self._store_cached(key or self._cache_key(digest, schedule), cache_dir)
         return self.instructions, self.label_dict
+
+    def assemble_file(self, path, schedule=False, cache_dir=None):
+        """Assembles a source file, streaming it only when it is not already cached."""
+        key = self.file_key(path, schedule)
+        if self._load_cached(key, cache_dir): return self.instructions, self.label_dict
+        with open(path) as f: self._assemble_lines(line.rstrip('\n') for line in f)
+        if schedule: self.schedule_branches()
+        self._store_cached(key, cache_dir)
+        return self.instructions, self.label_dict
+
+    @classmethod
+    def file_key(cls, path, schedule=False):
+        """Cache key of a source file: a hash of its contents, the assembler version and `schedule`."""
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 16), b''): digest.update(chunk)
+        return cls._cache_key(digest, schedule)
+
+    def load_data(self, dmem):
+        """Writes the initial .data words into `dmem`."""
+        for address, value in self.data.items(): dmem.store(address, value, 4)
+
+    @staticmethod
+    def _hashed(lines, digest):
+        for line in lines:
+            line = line.rstrip('\n')
+            digest.update(line.encode() + b'\n')
+            yield line
+
+    @staticmethod
+    def _cache_key(digest, schedule):
+        digest.update(f"\n{ASSEMBLER_VERSION}:{bool(schedule)}".encode())
+        return digest.hexdigest()
+
+    def _load_cached(self, key, cache_dir):
+        program = _assembly_cache.get(key)
+        path = os.path.join(cache_dir, key + ".pkl") if cache_dir else None
+        if program is None and path and os.path.exists(path):
+            with open(path, 'rb') as f: program = pickle.load(f)
+        if program is None: return False
+        _assembly_cache[key] = program
+        _assembly_cache.move_to_end(key)
+        # Each memory gets its own copies so nothing run on it leaks into the cache
+        self.instructions, self.label_dict, self.data_labels, self.data = self._copy_program(*program)
+        return True
+
+    @staticmethod
+    def _copy_program(instructions, label_dict, data_labels, data):
+        return list(map(copy.copy, instructions)), dict(label_dict), dict(data_labels), dict(data)
+
+    def _store_cached(self, key, cache_dir):
+        program = self._copy_program(self.instructions, self.label_dict, self.data_labels, self.data)
+        _assembly_cache[key] = program
+        if len(_assembly_cache) > ASSEMBLY_CACHE_SIZE: _assembly_cache.popitem(last=False)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(os.path.join(cache_dir, key + ".pkl"), 'wb') as f: pickle.dump(program, f)
+
+    def _assemble_lines(self, lines):
+        """Single pass over the source; %hi/%lo symbols and branch labels are checked once it ends."""
+        self.instructions, self.label_dict, self.data_labels, self.data = [], {}, {}, {}
+        section, data_address, fixups, label_refs = "text", DATA_BASE, [], []
+        for line_no, raw in enumerate(lines, 1):
+            line = raw.split('#')[0].strip()
+            while ':' in line:
+                label, line = (part.strip() for part in line.split(':', 1))
+                if not label.replace('_', '').replace('.', '').isalnum(): raise AssemblyError(line_no, "bad label", raw.strip())
+                if label in self.label_dict or label in self.data_labels: raise AssemblyError(line_no, f"duplicate label '{label}'", raw.strip())
+                if section == "text": self.label_dict[label] = 4 * len(self.instructions)
+                else: self.data_labels[label] = data_address
+            if not line: continue
+            parts = line.split(maxsplit=1)
+            opcode, operands = parts[0].lower(), [p.strip() for p in parts[1].split(',')] if len(parts) > 1 else []
+            if opcode.startswith('.'):
+                if opcode in (".text", ".data"): section = opcode[1:]
+                elif opcode == ".word":
+                    if section != "data": raise AssemblyError(line_no, ".word outside .data", raw.strip())
+                    for operand in operands:
+                        self.data[data_address] = self._number(operand, line_no, raw)
+                        data_address += 4
+                elif opcode not in (".globl", ".global", ".section", ".align"):
+                    raise AssemblyError(line_no, f"unknown directive '{opcode}'", raw.strip())
+                continue
+            if section != "text": raise AssemblyError(line_no, "instruction in .data", raw.strip())
+            if opcode in PSEUDO_INSTRUCTIONS:
+                arity, expand = PSEUDO_INSTRUCTIONS[opcode]
+                if len(operands) != arity: raise AssemblyError(line_no, f"'{opcode}' takes {arity} operand(s)", raw.strip())
+                try: expansion = expand(*operands)
+                except ValueError: raise AssemblyError(line_no, "bad immediate", raw.strip()) from None
+            else:
+                expansion = [(opcode, operands)]
+            for op, ops in expansion:
+                self.instructions.append(self._encode(op, ops, line_no, raw.strip(), fixups, label_refs))
+        for label, line_no, line in label_refs:
+            if label not in self.label_dict: raise AssemblyError(line_no, f"undefined label '{label}'", line)
+        for instr, kind, symbol, line_no, line in fixups:
+            address = self.label_dict.get(symbol, self.data_labels.get(symbol))
+            if address is None: raise AssemblyError(line_no, f"undefined symbol '{symbol}'", line)
+            lo = ((address & 0xFFF) ^ 0x800) - 0x800
+            instr.imm = lo if kind == "lo" else (address - lo) >> 12
+
+    def _encode(self, opcode, operands, line_no, line, fixups, label_refs):
+        if opcode not in OPCODE_FORMATS: raise AssemblyError(line_no, f"unknown instruction '{opcode}'", line)
+        fmt = OPCODE_FORMATS[opcode]
+        # Short forms: `jal label`, `jalr rs1`, `jalr rd, rs1` and `jalr rd, imm(rs1)`
+        if fmt == "J" and len(operands) == 1: operands = ["ra"] + operands
+        if fmt == "JR":
+            if len(operands) == 1: operands = ["ra", operands[0], "0"]
+            elif len(operands) == 2 and '(' in operands[1]: operands = [operands[0]] + self._split_mem(operands[1], line_no, line)[::-1]
+            elif len(operands) == 2: operands = operands + ["0"]
+        fields = OPERAND_FORMATS[fmt]
+        if len(operands) != len(fields):
+            raise AssemblyError(line_no, f"'{opcode}' takes {len(fields)} operand(s)", line)
+        instr = IC.Instruction(op=opcode, pc=4 * len(self.instructions))
+        for field, operand in zip(fields, operands):
+            if field in ("rd", "rs1", "rs2"): setattr(instr, field, self._register(operand, line_no, line))
+            elif field == "label": instr.imm = operand; label_refs.append((operand, line_no, line))
+            else:
+                if field == "mem":
+                    operand, base = self._split_mem(operand, line_no, line)
+                    instr.rs1 = self._register(base, line_no, line)
+                if operand.startswith(("%hi(", "%lo(")) and operand.endswith(")"):
+                    instr.imm = 0
+                    fixups.append((instr, operand[1:3], operand[4:-1].strip(), line_no, line))
+                else: instr.imm = self._number(operand, line_no, line)
+        return instr
+
+    @staticmethod
+    def _split_mem(operand, line_no, line):
+        if not operand.endswith(')') or '(' not in operand: raise AssemblyError(line_no, "expected imm(reg)", line)
+        imm, base = operand[:-1].rsplit('(', 1)
+        return [imm.strip() or "0", base.strip()]
+
+    @staticmethod
+    def _register(name, line_no, line):
+        name = {"fp": "s0"}.get(name, name)
+        reg = IC.INV_REG_NAME_MAP.get(name, name[1:] if name.startswith('x') else None)
+        if reg is None or not reg.isdigit() or not 0 <= int(reg) < 32: raise AssemblyError(line_no, f"bad register '{name}'", line)
+        return str(int(reg))
+
+    @staticmethod
+    def _number(text, line_no, line):
+        try: return int(text, 0)
+        except ValueError: raise AssemblyError(line_no, f"bad immediate '{text}'", line) from None
+
+    def schedule_branches(self, gap=None):
+        """Within each basic block, moves the producers of a branch's operands up past independent
+        instructions so that up to `gap` instructions separate them from the branch.
+
+        Register (RAW/WAR/WAW) and memory dependences are respected; stores are never reordered with
+        other memory accesses, auipc never moves, and a producer is not moved right behind a load it depends on.
+        Returns the number of branch sites improved.
+        """
+        gap = self.SCHEDULE_GAP if gap is None else gap
+        def dest(instr): return instr.get_dest_reg() if instr.get_dest_reg() != '0' else None
+        def barrier(instr): return BPUDecoder(instr).is_branch_type or instr.op in ("ecall", "ebreak")
+        def independent(a, b):
+            # auipc adds its own PC, so moving it (or anything past it) changes its result
+            if barrier(a) or barrier(b) or "auipc" in (a.op, b.op): return False
+            if dest(a) and (dest(a) in (b.rs1, b.rs2) or dest(a) == dest(b)): return False
+            if dest(b) and dest(b) in (a.rs1, a.rs2): return False
+            memory_ops = LOAD_OPS + STORE_OPS
+            return not (a.op in memory_ops and b.op in memory_ops and (a.op in STORE_OPS or b.op in STORE_OPS))
+
+        # Basic blocks start at labels and after control transfers
+        leaders, blocks = set(self.label_dict.values()), [[]]
+        for instr in self.instructions:
+            if blocks[-1] and (instr.pc in leaders or barrier(blocks[-1][-1])): blocks.append([])
+            blocks[-1].append(instr)
+        sites = improved = moves = 0
+        for block in blocks:
+            branch = block[-1]
+            if BPUDecoder(branch).is_branch_type not in (1, 2): continue
+            sites += 1
+            sources = {branch.rs1, branch.rs2} - {None, '0'}
+            site_improved = False
+            for reg in sources:
+                p = max((i for i, instr in enumerate(block[:-1]) if dest(instr) == reg), default=None)
+                # Stop at the other operand's producer so its distance never shrinks
+                while p and len(block) - p - 2 < gap and independent(block[p - 1], block[p]) and dest(block[p - 1]) not in sources:
+                    above = block[p - 2] if p >= 2 else None
+                    if above and above.op in LOAD_OPS and dest(above) in (block[p].rs1, block[p].rs2): break
+                    block[p - 1], block[p] = block[p], block[p - 1]
+                    p, moves, site_improved = p - 1, moves + 1, True
+            improved += site_improved
+        self.instructions = [instr for block in blocks for instr in block]
+        for i, instr in enumerate(self.instructions): instr.pc = 4 * i
+        print(f"[ASM] Branch scheduling: {improved} of {sites} branch sites improved ({moves} instructions moved)")
+        return improved
     
 class RISCV_ALU:
-    """Encapsulates all RISC-V execution logic."""
+    """Encapsulates all RISC-V execution logic: op -> handler(rs1_val, rs2_val, imm, pc)."""
+    OPS = {
+        "add": lambda a, b, imm, pc: a + b, "sub": lambda a, b, imm, pc: a - b,
+        "xor": lambda a, b, imm, pc: a ^ b, "or": lambda a, b, imm, pc: a | b,
+        "and": lambda a, b, imm, pc: a & b, "sll": lambda a, b, imm, pc: a << (b & 0x1F),
+        "slt": lambda a, b, imm, pc: 1 if a < b else 0,
+        "sltu": lambda a, b, imm, pc: 1 if (a & 0xFFFFFFFF) < (b & 0xFFFFFFFF) else 0,
+        "srl": lambda a, b, imm, pc: (a & 0xFFFFFFFF) >> (b & 0x1F),
+        "sra": lambda a, b, imm, pc: a >> (b & 0x1F),
+        "addi": lambda a, b, imm, pc: a + imm, "xori": lambda a, b, imm, pc: a ^ imm,
+        "ori": lambda a, b, imm, pc: a | imm, "andi": lambda a, b, imm, pc: a & imm,
+        "slti": lambda a, b, imm, pc: 1 if a < imm else 0,
+        "sltiu": lambda a, b, imm, pc: 1 if (a & 0xFFFFFFFF) < (imm & 0xFFFFFFFF) else 0,
+        "slli": lambda a, b, imm, pc: a << (imm & 0x1F),
+        "srli": lambda a, b, imm, pc: (a & 0xFFFFFFFF) >> (imm & 0x1F),
+        "srai": lambda a, b, imm, pc: a >> (imm & 0x1F),
+        **dict.fromkeys(LOAD_OPS + STORE_OPS, lambda a, b, imm, pc: a + imm),
+        "jalr": lambda a, b, imm, pc: pc + 4, "jal": lambda a, b, imm, pc: pc + 4,
+        "auipc": lambda a, b, imm, pc: pc + (imm << 12), "lui": lambda a, b, imm, pc: imm << 12,
+    }
+
     def execute(self, instr, pc, rs1_val, rs2_val):
-        op, imm = instr.op, instr.imm or 0
-        rs1_val, rs2_val = rs1_val or 0, rs2_val or 0
-        ops = {
-            "add": lambda: rs1_val + rs2_val, "sub": lambda: rs1_val - rs2_val,
-            "xor": lambda: rs1_val ^ rs2_val, "or": lambda: rs1_val | rs2_val,
-            "and": lambda: rs1_val & rs2_val, "sll": lambda: rs1_val << (rs2_val & 0x1F),
-            "slt": lambda: 1 if rs1_val < rs2_val else 0,
-            "sltu": lambda: 1 if (rs1_val & 0xFFFFFFFF) < (rs2_val & 0xFFFFFFFF) else 0,
-            "srl": lambda: (rs1_val & 0xFFFFFFFF) >> (rs2_val & 0x1F),
-            "sra": lambda: rs1_val >> (rs2_val & 0x1F),
-            "addi": lambda: rs1_val + imm, "xori": lambda: rs1_val ^ imm,
-            "ori": lambda: rs1_val | imm, "andi": lambda: rs1_val & imm,
-            "slti": lambda: 1 if rs1_val < imm else 0,
-            "sltiu": lambda: 1 if (rs1_val & 0xFFFFFFFF) < (imm & 0xFFFFFFFF) else 0,
-            "slli": lambda: rs1_val << (imm & 0x1F),
-            "srli": lambda: (rs1_val & 0xFFFFFFFF) >> (imm & 0x1F),
-            "srai": lambda: rs1_val >> (imm & 0x1F),
-            "lb": lambda: rs1_val + imm, "lh": lambda: rs1_val + imm, "lw": lambda: rs1_val + imm,
-            "lbu": lambda: rs1_val + imm, "lhu": lambda: rs1_val + imm,
-            "sb": lambda: rs1_val + imm, "sh": lambda: rs1_val + imm, "sw": lambda: rs1_val + imm,
-            "jalr": lambda: rs1_val + imm,
-            "auipc": lambda: pc + (imm << 12), "lui": lambda: imm << 12,
-            "jal": lambda: pc + 4, "ecall": lambda: 0, "ebreak": lambda: 0
-        }
-        return ops.get(op, lambda: 0)()
+        handler = self.OPS.get(instr.op)
+        return handler(rs1_val or 0, rs2_val or 0, instr.imm or 0, pc) if handler else 0
+
+# What the shared pipeline engine needs from an instruction set. Front ends lower their control flow
+# and memory instructions to the engine's canonical classes (BPUDecoder, LOAD_OPS/STORE_OPS, Comparator)
+# and name their own operations in the ALU's OPS table and their instruction class's WRITES_RD.
+ISA = collections.namedtuple('ISA', ['name', 'assembler', 'alu', 'register_file'])
+RV32I = ISA("RV32I", InstructionMemory, RISCV_ALU, RegisterFile)
@@ -0,0 +1,144 @@
+"""Differential co-simulation: a reference interpreter in a worker process checks the pipeline.
+
+Every instruction retiring from simulate() is sent over a pipe, in batches, to a worker that runs
+the functional model one instruction at a time and compares the PC, the destination register value
+and the memory write. The simulation only pays for recording and sending each batch.
+"""
+import collections
+import contextlib
+import io
+import multiprocessing
+import component_def as cd
+import full_pipeline_risc32i as fp
+import lockstep as ls
+
+BATCH_SIZE = 512      # retired instructions per message to the worker
+CONTEXT = 8           # reference instructions quoted before a divergence
+# One record per retired pipeline instruction; `store` is (address, bytes, value read back from memory)
+RetiredRecord = collections.namedtuple('RetiredRecord', ['cycle', 'pc', 'op', 'dest', 'value', 'store'])
+
+
+def _describe(rec):
+    effect = f"x{rec.dest}={rec.value}" if rec.dest else ""
+    if rec.store: effect = f"Mem[{rec.store[0]:#x}]={rec.store[2] & (1 << 8 * rec.store[1]) - 1:#x}"
+    return f"PC {rec.pc:#x} {rec.instr.op} {effect}".rstrip()
+
+
+def _mismatch(retired, rec):
+    if rec is None: return "retired after the program ended"
+    if retired.pc != rec.pc: return f"expected {rec.instr.op} at PC {rec.pc:#x}"
+    if (retired.dest, retired.value) != (rec.dest, rec.value):
+        return f"wrote x{retired.dest}={retired.value}, expected x{rec.dest}={rec.value}"
+    if rec.store:
+        address, num_bytes, value = rec.store
+        if retired.store != (address, num_bytes, value & (1 << 8 * num_bytes) - 1):
+            return f"stored {retired.store}, expected Mem[{address:#x}]={value & (1 << 8 * num_bytes) - 1:#x}"
+    return None
+
+
+def reference_worker(conn, imem, stdin=b"", heap_base=cd.HEAP_BASE, max_steps=10_000_000, context=CONTEXT, isa=cd.RV32I):
+    """Worker process: checks batches of RetiredRecords received on `conn` until the stream ends.
+
+    The stream ends with {'truncated': flag} instead of a batch. Replies once, either as soon as a
+    record diverges or with a summary when the stream ends. The reference runs on `isa`'s ALU and
+    register file.
+    """
+    recent, checked = collections.deque(maxlen=context), 0
+
+    def report(divergence, retired=None):
+        conn.send({'checked': checked, 'divergence': divergence, 'cycle': retired.cycle if retired else None,
+                   'context': [_describe(rec) for rec in recent]})
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        steps = ls.functional_steps(imem, isa.register_file(), cd.DataMemory(), cd.SyscallHandler(stdin, heap_base), isa.alu())
+        try:
+            while True:
+                batch = conn.recv()
+                if isinstance(batch, dict): break
+                for retired in batch:
+                    rec = next(steps, None)
+                    # The BPU drops the branches and jumps it resolves in fetch, so they never retire
+                    while rec is not None and rec.pc != retired.pc and ls.folded_by_bpu(rec):
+                        recent.append(rec)
+                        rec = next(steps, None)
+                    error = _mismatch(retired, rec)
+                    if error:
+                        return report(f"{retired.op} at PC {retired.pc:#x} {error}", retired)
+                    recent.append(rec)
+                    checked += 1
+                    if checked == max_steps: return report(f"reference did not finish within {max_steps} instructions")
+            # Whatever the reference still executes must not have been lost by the pipeline, unless
+            # simulate stopped at its max_cycles before retiring it
+            for rec in ([] if batch['truncated'] else steps):
+                if rec.dest is not None or rec.store:
+                    return report(f"the pipeline stopped retiring before {rec.instr.op} at PC {rec.pc:#x}")
+                recent.append(rec)
+            report(None)
+        except Exception as e:
+            report(f"reference model failed: {e!r}")
+
+
+def cosimulate(imem, rf, dmem, batch_size=BATCH_SIZE, **simulate_kwargs):
+    """Runs fp.simulate with a reference interpreter in a worker process checking every retired instruction.
+
+    Takes simulate's keyword arguments (a given `on_retire` is still called) and returns its
+    (cycles, stalls). Raises lockstep.DivergenceError at the first PC, register or memory
+    mismatch, quoting the last reference instructions that agreed. A run cut short by
+    `max_cycles` is only checked up to its last retired instruction.
+    """
+    syscalls = simulate_kwargs.setdefault('syscalls', cd.SyscallHandler())
+    stats = simulate_kwargs.setdefault('stats', {})
+    on_retire = simulate_kwargs.pop('on_retire', None)
+    conn, worker_conn = multiprocessing.Pipe()
+    worker = multiprocessing.Process(target=reference_worker, args=(worker_conn, imem, syscalls.stdin, syscalls.heap_base),
+                                     kwargs={'isa': simulate_kwargs.get('isa', cd.RV32I)}, daemon=True)
+    worker.start()
+    worker_conn.close()
+    batch = []
+
+    def send(message):
+        # A worker that has found a divergence replies and exits, closing its end of the pipe
+        with contextlib.suppress(BrokenPipeError): conn.send(message)
+
+    def fail(result):
+        cycle = f"Cycle {result['cycle']}: " if result['cycle'] else ""
+        raise ls.DivergenceError(f"{cycle}{result['divergence']} (after {result['checked']} matching instructions)\n"
+                                 + "\n".join("    " + line for line in result['context']))
+
+    def record(instr, cycle):
+        dest = instr.get_dest_reg() if instr.get_dest_reg() != '0' else None
+        num_bytes = ls.ACCESS_BYTES.get(instr.op) if instr.op in cd.STORE_OPS else None
+        store = (instr.result, num_bytes, dmem.load(instr.result, num_bytes, False)) if num_bytes else None
+        batch.append(RetiredRecord(cycle, instr.pc, instr.op, dest, instr.result if dest else None, store))
+        if len(batch) == batch_size:
+            # The worker only replies before the end of the stream when it has found a divergence
+            if conn.poll(): fail(conn.recv())
+            send(batch)
+            batch.clear()
+        if on_retire: on_retire(instr, cycle)
+
+    try:
+        result = fp.simulate(imem, rf, dmem, on_retire=record, **simulate_kwargs)
+        send(batch)
+        send({'truncated': stats['truncated']})
+        summary = conn.recv()
+        if summary['divergence']: fail(summary)
+        truncated = f" (run truncated after {simulate_kwargs['max_cycles']} cycles)" if stats['truncated'] else ""
+        print(f"[COSIM] {summary['checked']} retired instructions match the reference model{truncated}")
+        return result
+    finally:
+        worker.kill()
+        worker.join()
+        conn.close()
+
+
+if __name__ == "__main__":
+    import program_gen as pg
+    for seed in range(4):
+        for depth, config in fp.PIPELINES.items():
+            imem = cd.InstructionMemory()
+            with contextlib.redirect_stdout(io.StringIO()):
+                imem.assemble(pg.generate_program(400, seed))
+                cycles, stalls = cosimulate(imem, cd.RegisterFile(), cd.DataMemory(), branch_policy="speculate",
+                                            predictor="bimodal", pipeline_config=config)
+            print(f"seed {seed}, {depth}-stage: {cycles} cycles, {stalls} stalls, no divergence")
@@ -1,131 +1,423 @@
 import collections
-import Instruction_class as IC
+import contextlib
+import copy
+import io
 import component_def as cd
 import stages_def as stg   
 # --- SIMULATOR ---
-STAGES = ["IF", "ID", "EX", "MEM", "WB"]
+# Number of IF, EX and MEM stages; ID and WB are always a single stage.
+# Only the last EX stage computes and only the last MEM stage accesses memory.
+PipelineConfig = collections.namedtuple('PipelineConfig', ['fetch', 'execute', 'memory'], defaults=(1, 1, 1))
+PIPELINES = {5: PipelineConfig(1, 1, 1), 7: PipelineConfig(2, 2, 1), 9: PipelineConfig(2, 2, 3)}
+MEMORY_OPS = cd.LOAD_OPS + ["sb", "sh", "sw"]
+SERIAL_OPS = ["ecall", "ebreak"]   # always issue alone
+CACHE_CONFIG = dict(size=256, ways=2, line_size=16, replacement="lru", hit_latency=1, miss_latency=8)
+# Energy per BPU event in pJ, plus 'cycle' for the rest of the core per cycle. Illustrative figures only:
+# pass a table for the target process to energy_report().
+ENERGY_TABLE_PJ = {"decode": 0.4, "bta": 0.3, "compare": 0.2, "rf_read": 0.5, "precompute": 1.2, "cycle": 10.0}
 
 
+def stage_names(config):
+    def names(prefix, count): return [prefix] if count == 1 else [f"{prefix}{i}" for i in range(1, count + 1)]
+    return names("IF", config.fetch) + ["ID"] + names("EX", config.execute) + names("MEM", config.memory) + ["WB"]
 
-def simulate(imem, rf, dmem):
-    pc, cycle, total_stalls = 0, 0, 0
-    pipeline = {s: None for s in STAGES}
-    alu = cd.RISCV_ALU()
-    bpu = cd.BranchPrecomputationUnit(imem, alu) 
-    
-    if pc < len(imem.instructions) * 4:
-        pipeline["IF"] = imem.instructions[pc // 4]
+
+def can_dual_issue(instr1, instr2, instr2_resolved):
+    """Pairing rules for the second issue slot of a dual-issue group."""
+    if not instr1 or not instr2: return False
+    if cd.BPUDecoder(instr1).is_branch_type or instr1.op in SERIAL_OPS or instr2.op in SERIAL_OPS: return False
+    # A branch may only sit in slot 2, and only once the BPU has resolved it as not taken
+    if cd.BPUDecoder(instr2).is_branch_type and not instr2_resolved: return False
+    if instr1.op in MEMORY_OPS and instr2.op in MEMORY_OPS: return False   # one data-memory port
+    dest1 = instr1.get_dest_reg()
+    # No RAW or WAW between the slots: there is no forwarding path inside a group
+    return not (dest1 and dest1 != '0' and dest1 in (instr2.rs1, instr2.rs2, instr2.get_dest_reg()))
+
+
+def simulate(imem, rf, dmem, branch_policy="stall", predictor="not-taken", issue_width=1, pipeline_config=None, stats=None,
+             icache=None, dcache=None, bpu_icache_port=False, on_retire=None, syscalls=None, isa=cd.RV32I,
+             max_cycles=None):
+    """Runs the pipeline to completion and returns (cycles, stalls).
+
+    Every stage holds a group of up to `issue_width` (1 or 2) instructions, oldest first.
+    `pipeline_config` (a PipelineConfig, default 5 stages) sets the stage depths; the BPU
+    always inspects the last fetch stage. If a `stats` dict is given it is filled with the
+    detailed counters, including the fetch slots wasted on mispredicted speculation (which
+    are not counted as stalls).
+
+    `icache`/`dcache` are optional cd.Cache models: an I-cache miss leaves bubbles in the
+    first fetch stage until the line arrives, a D-cache miss freezes the whole pipeline while
+    the last MEM stage waits. With `bpu_icache_port` the BPU's look-ahead shares the I-cache
+    port with fetch. Cache stall cycles are reported in `stats`, not in the returned stalls.
+    `on_retire(instr, cycle)` is called for every instruction leaving WB, in program order.
+
+    An ecall runs its system call on `syscalls` (a cd.SyscallHandler, a fresh one by default)
+    in the last MEM stage. Nothing behind it is decoded or resolved by the BPU until then, and
+    it is not issued past an unresolved branch. exit ends the simulation at once; the exit
+    code and console output are reported in `stats`.
+
+    `isa` (a cd.ISA) supplies the ALU; the program must come from the same ISA's assembler.
+    With `max_cycles` the run stops after that many cycles and `stats['truncated']` is set.
+    """
+    if issue_width not in (1, 2): raise ValueError("issue_width must be 1 or 2")
+    config = pipeline_config or PipelineConfig()
+    stages = stage_names(config)
+    # Stage positions: the fetch stages come first, then ID, the last EX stage and the last MEM stage
+    id_pos = config.fetch
+    ex_pos, mem_pos = id_pos + config.execute, id_pos + config.execute + config.memory
+    fetch_pc, cycle, total_stalls = 0, 0, 0
+    imem.load_data(dmem)
+    stats = {} if stats is None else stats
+    stats.update(stages=len(stages), speculative_fetches=0, wasted_slots=0, dual_issues=0, icache_stalls=0, dcache_stalls=0,
+                 bpu_active_cycles=0, bpu_peak_activity=0, truncated=False)
+    pipeline = {s: [] for s in stages}
+    alu = isa.alu()
+    # In dual issue the fetch group already covers the BPU's window, so the look-ahead needs no access of its own
+    bpu = cd.BranchPrecomputationUnit(imem, alu, branch_policy, predictor,
+                                      icache if bpu_icache_port and issue_width == 1 else None)
+    fetch_ready, dcache_group, dcache_wait = None, None, 0
+    syscalls = cd.SyscallHandler() if syscalls is None else syscalls
+
+    def fetch(pc, count=issue_width):
+        # Each fetch gets its own copy so loop iterations in flight do not share result fields
+        group = []
+        for pc in range(pc, pc + 4 * count, 4):
+            if pc >= len(imem.instructions) * 4: break
+            instr = copy.copy(imem.instructions[pc // 4])
+            if bpu.pending_branch:
+                instr.spec_tag = bpu.pending_branch['tag']
+                stats['speculative_fetches'] += 1
+            group.append(instr)
+        return group
+
+    def fetch_latency(pc, count=issue_width):
+        # One I-cache access per line the fetch group touches
+        if not icache: return 1
+        lines = {a // icache.line_size for a in range(pc, pc + 4 * count, 4) if a < len(imem.instructions) * 4}
+        return max((icache.access(line * icache.line_size) for line in sorted(lines)), default=1)
+
+    def shift(groups, first, incoming):
+        """Advances stages first..WB by one position, `incoming` entering at `first`."""
+        for pos in range(len(stages) - 1, first, -1):
+            pipeline[stages[pos]] = groups[pos - 1]
+        pipeline[stages[first]] = incoming
+
+    def forwarding(groups, positions):
+        return [{'reg': i.get_dest_reg(), 'val': i.result, 'instr_op': i.op, 'tag': i.spec_tag}
+                for pos in positions for i in reversed(groups[pos]) if i.get_dest_reg() and i.result is not None]
+
+    def cycles_until_forwardable(instr, pos):
+        # ALU results can be forwarded once the last EX stage is done, loads once the last MEM stage is
+        return max(0, (mem_pos if instr.op in cd.LOAD_OPS else ex_pos) - pos)
+
+    fetch_ready = fetch_latency(fetch_pc) - 1
+    if fetch_ready == 0:
+        pipeline[stages[0]] = fetch(fetch_pc)
+        fetch_pc, fetch_ready = fetch_pc + 4 * len(pipeline[stages[0]]), None
         
-    while any(pipeline.values()):
+    while any(pipeline.values()) or fetch_ready is not None:
+        if cycle == max_cycles:
+            stats['truncated'] = True
+            print(f"\n[SYSTEM] Cycle limit of {max_cycles} reached")
+            break
         cycle += 1
-        print(f"\nCycle {cycle:02d} (PC=0x{pc:X}) | Pipeline: {{ {', '.join(f'{s}: {str(i)}' for s, i in pipeline.items())} }}")
+        groups = [pipeline[s] for s in stages]   # contents at the start of the cycle, by position
+        fetch_group = groups[id_pos - 1]
+        pc = fetch_group[0].pc if fetch_group else None
+        stage_text = ', '.join(f"{s}: {'+'.join(map(str, g)) or None}" for s, g in pipeline.items())
+        print(f"\nCycle {cycle:02d} (PC=0x{fetch_pc if pc is None else pc:X}) | Pipeline: {{ {stage_text} }}")
+        for cache in (icache, dcache):
+            if cache: cache.cycle = cycle
+
+        # --- D-CACHE: a group entering the last MEM stage holds the whole pipeline until its access completes ---
+        if dcache and groups[mem_pos] is not dcache_group:
+            dcache_group = groups[mem_pos]
+            dcache_wait = max((dcache.access(i.result) for i in dcache_group if i.op in MEMORY_OPS), default=1) - 1
+        if dcache_wait:
+            print(f"    [PIPELINE] D-cache miss STALL ({dcache_wait} cycle(s) left).")
+            dcache_wait -= 1
+            stats['dcache_stalls'] += 1
+            continue
 
         # --- Pipeline stages execute in reverse order ---
-        stg.WB(pipeline["WB"], rf)
-        mem_completed_instr = stg.MEM(pipeline["MEM"], dmem, rf, pipeline["EX"], pipeline["WB"])
+        for instr in groups[-1]:
+            stg.WB(instr, rf)
+            if on_retire: on_retire(instr, cycle)
+        # WB has already written the register file, so a store's data is read directly from it
+        for instr in groups[mem_pos]: stg.MEM(instr, dmem, rf, syscalls=syscalls)
+        if syscalls.exit_code is not None:
+            print(f"    [SYSTEM] Program exited with code {syscalls.exit_code}")
+            break
         
         # EX stage now ONLY does forwarding and execution. It no longer signals stalls.
-        ex_completed_instr = stg.EX_with_forwarding(pipeline["EX"], pipeline["MEM"], pipeline["WB"], alu)
+        stg.EX_group(groups[ex_pos], [i for g in groups[ex_pos + 1:] for i in reversed(g)], alu, rf)
         
-        id_completed_instr = stg.ID(pipeline["ID"], rf)
+        for instr in groups[id_pos]: stg.ID(instr, rf)
 
         # --- NEW: ID STAGE HAZARD DETECTION ---
         # This logic runs AFTER the ID stage but BEFORE the pipeline advances.
-        # It checks if the instruction LEAVING ID depends on a load in the EX stage.
-        hazard_stall = False
-        load_opcodes = ["lw", "lb", "lh", "lbu", "lhu"]
-        
-        instr_in_EX = pipeline["EX"] # This is the instruction that just finished its ID stage
-        instr_in_ID = pipeline["ID"] # This is the instruction currently in the ID stage
-        
-        # The classic load-use hazard: instr in ID needs the result of instr in EX
-        if instr_in_EX and instr_in_EX.op in load_opcodes:
-            dest_reg = instr_in_EX.get_dest_reg()
-            if dest_reg and instr_in_ID:
-                if dest_reg in [instr_in_ID.rs1, instr_in_ID.rs2]:
-                    # This check is more specific to the simulator's structure
-                    # where the instruction to be stalled is the one in ID
-                    hazard_stall = True
+        # An instruction leaving ID reaches the last EX stage `execute` cycles later, so it stalls if
+        # the youngest producer of one of its operands is a load that will not have left the last
+        # MEM stage by then. Branches and jumps are exempt: their operands are consumed by the BPU.
+        inflight = [(i, pos) for pos in range(id_pos + 1, len(stages)) for i in reversed(groups[pos])]
+        def load_use(reg):
+            producer = next(((i, pos) for i, pos in inflight if i.get_dest_reg() == reg), None)
+            return producer and producer[0].op in cd.LOAD_OPS and producer[1] <= id_pos + config.memory
+        hazard_stall = any(not cd.BPUDecoder(i).is_branch_type and any(load_use(r) for r in {i.rs1, i.rs2} - {None, '0'})
+                           for i in groups[id_pos])
         
+        # --- Update BPU forwarding paths for the *next* cycle ---
+        # Earlier EX stages only hold results the BPU pre-computed in ID
+        bpu.forwarding_ex_mem = forwarding(groups, range(id_pos + 1, mem_pos))
+        bpu.forwarding_mem_wb = forwarding(groups, [mem_pos])
+        # ECALL SERIALIZATION: a0 is only written once the ecall's system call has run in MEM
+        serializing = any(i.op == "ecall" for g in groups[id_pos:mem_pos] for i in g)
+        held = hazard_stall or serializing
+        spec_tag = bpu.spec_tag
+
         # --- THE CORRECTED STALL HANDLER ---
-        if hazard_stall:
-            print("    [PIPELINE] Load-use hazard STALL (ID stage).")
+        # A pending branch still resolves while the front end holds; if it was mispredicted, everything
+        # in ID and fetch is on the wrong path and the squash below takes the place of the stall
+        if held and not bpu.skip_cycle(rf):
             total_stalls += 1
-            
-            # Advance the back-end of the pipeline
-            pipeline["WB"] = mem_completed_instr
-            pipeline["MEM"] = ex_completed_instr
-            
-            # Inject a bubble into EX, holding the dependent instruction in ID.
-            pipeline["EX"] = None 
-            # pipeline["ID"] is NOT changed.
-            # pipeline["IF"] is NOT changed.
-            # PC is NOT changed.
-            
-            # Use 'continue' to restart the loop, effectively re-processing the ID/IF stages
+            if hazard_stall:
+                print("    [PIPELINE] Load-use hazard STALL (ID stage).")
+                # Advance the back-end, injecting a bubble after ID; ID, the fetch stages and the PC hold
+                shift(groups, id_pos + 1, [])
+            else:
+                print("    [PIPELINE] Serializing on ecall.")
+                shift(groups, id_pos, [])
+                bpu.last_checked_pc = None
             continue
 
-        # --- Update BPU forwarding paths for the *next* cycle ---
-        # This must be done AFTER the stall check
-        bpu.forwarding_ex_mem = {'reg': ex_completed_instr.get_dest_reg(), 'val': ex_completed_instr.result, 'instr_op': ex_completed_instr.op} if ex_completed_instr else None
-        bpu.forwarding_mem_wb = {'reg': mem_completed_instr.get_dest_reg(), 'val': mem_completed_instr.result, 'instr_op': mem_completed_instr.op} if mem_completed_instr else None
-        bpu.run_bpu_cycle(pc, id_completed_instr, ex_completed_instr, rf)
+        if not held:
+            producers = [(i.get_dest_reg(), cycles_until_forwardable(i, pos)) for i, pos in inflight if pos <= mem_pos and i.get_dest_reg()]
+            id_producers = []
+            for instr in reversed(groups[id_pos]):
+                if not instr.get_dest_reg(): continue
+                # The BPU pre-computes an ID-stage ALU result only if its own operands are forwardable now
+                precomputable = instr.op not in cd.NO_PRECOMPUTE_OPS and not cd.operand_wait([instr.rs1, instr.rs2], producers)
+                id_producers.append((instr.get_dest_reg(), 0 if precomputable else cycles_until_forwardable(instr, id_pos)))
+            events = sum(bpu.activity.values())
+            bpu.run_bpu_cycle(pc, groups[id_pos], id_producers + producers, rf)
+            events = sum(bpu.activity.values()) - events
+            stats['bpu_active_cycles'] += events > 0
+            stats['bpu_peak_activity'] = max(stats['bpu_peak_activity'], events)
 
         # --- BPU STALL HANDLER (for branch dependencies) ---
-        if bpu.system_stall_request:
-            print("    [PIPELINE] Stalled by BPU (branch dependency).")
+        ecall_waits = bpu.pending_branch and fetch_group[:1] and fetch_group[0].op == "ecall" \
+            and not (bpu.final_directive and bpu.final_directive.is_taken)
+        if bpu.system_stall_request or ecall_waits:
+            print("    [PIPELINE] Stalled by BPU (" + ("ecall behind an unresolved branch)." if ecall_waits else "branch dependency)."))
             total_stalls += 1
-            # Advance pipeline but keep PC the same and nullify ID
-            pipeline["WB"] = mem_completed_instr
-            pipeline["MEM"] = ex_completed_instr
-            pipeline["EX"] = id_completed_instr
-            pipeline["ID"] = None
+            # Advance pipeline from ID on but keep the fetch stages and PC the same and nullify ID
+            shift(groups, id_pos, [])
             bpu.last_checked_pc = None # Force BPU to re-evaluate next cycle
             continue
-
-        # --- If no stalls, advance the pipeline normally ---
-        pipeline["WB"] = mem_completed_instr
-        pipeline["MEM"] = ex_completed_instr
-        pipeline["EX"] = id_completed_instr
+        if bpu.spec_tag != spec_tag:
+            # Just started speculating: an instr2 behind the branch and instructions already in earlier fetch
+            # stages are past it too. A tag left from an earlier, resolved speculation is stale and is replaced.
+            for instr in fetch_group[1:] + [i for g in groups[:id_pos - 1] for i in g]:
+                stats['speculative_fetches'] += instr.spec_tag is None
+                instr.spec_tag = bpu.pending_branch['tag']
         
         # --- Control Flow and Fetch ---
         directive = bpu.final_directive
-        if directive and directive.is_taken:
-            pc = directive.target_pc
-            pipeline["ID"] = None # Flush the instruction that was just decoded
-            print(f"    [CONTROL] BPU directive is TAKEN. New PC=0x{pc:X}. Flushing ID.")
+        redirect = directive and directive.is_taken
+        if redirect:
+            fetch_pc = directive.target_pc
+            if bpu.squash_tag is not None:
+                # Misspeculation: squash everything fetched under the wrong prediction and restore the PC
+                wrong_path = [i for g in groups for i in g if i.spec_tag == bpu.squash_tag]
+                stats['wasted_slots'] += len(wrong_path)
+                groups = [[i for i in g if i not in wrong_path] for g in groups]
+                issued = []
+                print(f"    [CONTROL] Misspeculation. New PC=0x{fetch_pc:X}. Squashed {len(wrong_path)} speculative instruction(s).")
+            else:
+                # flush=0: the branch was instr2, so instr1 in IF is still on the correct path
+                issued = fetch_group[:1] if directive.flush == 0 else []
+                print(f"    [CONTROL] BPU directive is TAKEN. New PC=0x{fetch_pc:X}. Flushing ID.")
         else:
-            pc += 4
-            pipeline["ID"] = pipeline["IF"] # Advance IF to ID
-            
+            # Issue instr1, plus instr2 when the pairing rules allow it
+            issued = fetch_group[:1]
+            if issue_width == 2 and len(fetch_group) == 2 and can_dual_issue(*fetch_group, bpu.instr2_resolved):
+                issued = fetch_group
+                stats['dual_issues'] += 1
+
+        # --- Advance the pipeline; a redirect empties the earlier fetch stages ---
+        shift(groups, id_pos, issued)
         bpu.last_checked_pc = None # Reset check for new PC
+        # An instr2 left behind stays in the last fetch stage, and every fetch stage moves up by one slot:
+        # each group is topped up from the one behind it and the first fetch stage fetches one fewer
+        leftover = [] if redirect else fetch_group[len(issued):]
+        for pos in range(id_pos - 1, 0, -1):
+            behind = [] if redirect else groups[pos - 1]
+            pipeline[stages[pos]] = leftover + behind[:issue_width - len(leftover)]
+            leftover = behind[issue_width - len(leftover):]
+        count = issue_width - len(leftover)
 
-        # Fetch the next instruction
-        if pc < len(imem.instructions) * 4:
-            pipeline["IF"] = imem.instructions[pc // 4]
+        # Fetch the next instruction(s) once the I-cache has delivered them; a redirect abandons an
+        # outstanding fetch, and a BPU look-ahead access this cycle delays a new one by a cycle
+        if redirect or fetch_ready is None:
+            fetch_ready = cycle + fetch_latency(fetch_pc, count) - 1 + bpu.icache_port_used
+        if cycle >= fetch_ready:
+            fetched = fetch(fetch_pc, count)
+            pipeline[stages[0]] = leftover + fetched
+            fetch_pc += 4 * len(fetched) if fetched else 4 * count
+            fetch_ready = None
         else:
-            pipeline["IF"] = None
+            pipeline[stages[0]] = leftover
+            stats['icache_stalls'] += 1
     
+    stats.update(cycles=cycle, stalls=total_stalls, late_resolved=bpu.late_resolved, mispredicts=bpu.late_flushes)
+    for cache in (icache, dcache):
+        if cache: stats[cache.name] = cache.stats()
+    stats['bpu_icache_accesses'] = bpu.icache_accesses
+    stats['bpu_activity'] = dict(bpu.activity)
+    stats.update(exit_code=syscalls.exit_code, stdout=bytes(syscalls.stdout), stderr=bytes(syscalls.stderr))
     print(f"\nSimulation completed in {cycle} cycles")
+    if branch_policy != "stall":
+        print(f"Late-resolved branches: {bpu.late_resolved}, mispredicted: {bpu.late_flushes}, wasted fetch slots: {stats['wasted_slots']}")
+    if issue_width == 2:
+        print(f"Dual-issued groups: {stats['dual_issues']}")
+    for cache in (icache, dcache):
+        if cache:
+            st = stats[cache.name]
+            print(f"{cache.name}: {st['hits']} hits, {st['misses']} misses ({st['hit_rate']:.0%} hit rate)")
+    if icache or dcache:
+        print(f"I-cache stall cycles: {stats['icache_stalls']}, D-cache stall cycles: {stats['dcache_stalls']}")
     return cycle, total_stalls
 
 
+def energy_report(stats, energy_table=ENERGY_TABLE_PJ, clock_ns=1.0, verbose=True):
+    """Combines the BPU activity counters of a simulate() `stats` dict with a per-event energy table.
+
+    `energy_table` maps cd.BPU_EVENTS (and optionally 'cycle') to pJ; returns the per-event and total
+    energy (pJ), the delay (ns) and the energy-delay product (pJ*ns).
+    """
+    unknown = set(energy_table) - set(cd.BPU_EVENTS) - {"cycle"}
+    if unknown: raise ValueError(f"Unknown energy events: {sorted(unknown)}")
+    counts = dict(stats['bpu_activity'], cycle=stats['cycles'])
+    per_event = {event: counts[event] * energy_table.get(event, 0.0) for event in cd.BPU_EVENTS + ["cycle"]}
+    energy, delay = sum(per_event.values()), stats['cycles'] * clock_ns
+    report = {'per_event': per_event, 'energy_pj': energy, 'delay_ns': delay, 'edp': energy * delay}
+    if verbose:
+        print("\n" + "="*60 + "\nBPU ENERGY REPORT\n" + "="*60)
+        for event, pj in per_event.items():
+            print(f"{event:>10}: {counts[event]:6d} x {energy_table.get(event, 0.0):6.2f} pJ = {pj:9.2f} pJ")
+        print(f"BPU active in {stats['bpu_active_cycles']} of {stats['cycles']} cycles, peak {stats['bpu_peak_activity']} events/cycle")
+        print(f"Total energy: {energy:.2f} pJ, delay: {delay:.2f} ns, EDP: {report['edp']:.2f} pJ*ns")
+    return report
+
+
+def compare_branch_policies(instr_list, issue_width=1, pipeline_config=None, icache_config=None, dcache_config=None,
+                            bpu_icache_port=False, energy_table=ENERGY_TABLE_PJ, schedule=False, isa=cd.RV32I):
+    """Runs the program under every BPU branch policy (and predictor) on fresh state and reports cycles saved over 'stall'.
+
+    `icache_config`/`dcache_config` are cd.Cache keyword arguments; every run gets cold caches.
+    Energy and EDP are computed with `energy_table` (see energy_report). `schedule` runs the
+    assembler's branch-aware scheduling pass first. `isa` selects the front end (see simulate).
+    """
+    configs = [("stall", "not-taken"), ("late", "not-taken")] + [("speculate", p) for p in cd.PREDICTORS]
+    results = {}
+    for policy, predictor in configs:
+        imem, rf, dmem = isa.assembler(), isa.register_file(), cd.DataMemory()
+        with contextlib.redirect_stdout(io.StringIO()):
+            imem.assemble(instr_list, schedule)
+        name = f"{policy}/{predictor}" if policy == "speculate" else policy
+        results[name] = {}
+        icache = cd.Cache("I-cache", **icache_config) if icache_config is not None else None
+        dcache = cd.Cache("D-cache", **dcache_config) if dcache_config is not None else None
+        with contextlib.redirect_stdout(io.StringIO()):
+            simulate(imem, rf, dmem, branch_policy=policy, predictor=predictor, issue_width=issue_width,
+                     pipeline_config=pipeline_config, stats=results[name], icache=icache, dcache=dcache,
+                     bpu_icache_port=bpu_icache_port, isa=isa)
+    depth = results["stall"]['stages']
+    scheduled = ", scheduled" if schedule else ""
+    print("\n" + "="*60 + f"\nBRANCH POLICY COMPARISON ({depth} stages, issue width {issue_width}{scheduled})\n" + "="*60)
+    base_cycles = results["stall"]['cycles']
+    for name, st in results.items():
+        cache_text = ''.join(f", {c} {st[c]['misses']} misses" for c in ("I-cache", "D-cache") if c in st)
+        st['energy'] = energy_report(st, energy_table, verbose=False)
+        print(f"{name:>19}: {st['cycles']} cycles, {st['stalls']} stalls, {st['wasted_slots']} wasted fetch slots{cache_text}, "
+              f"{base_cycles - st['cycles']} cycles saved vs stall, {st['energy']['energy_pj']:.1f} pJ, EDP {st['energy']['edp']:.0f}")
+    return results
+
+
+def check_dual_issue(instr_list, isa=cd.RV32I):
+    """Raises RuntimeError if dual issue takes more cycles than single issue at any pipeline depth.
+
+    Returns {depth: (single-issue cycles, dual-issue cycles)}.
+    """
+    results = {}
+    for depth, config in PIPELINES.items():
+        cycles = []
+        for width in (1, 2):
+            imem = isa.assembler()
+            with contextlib.redirect_stdout(io.StringIO()):
+                imem.assemble(instr_list)
+                cycles.append(simulate(imem, isa.register_file(), cd.DataMemory(), issue_width=width, pipeline_config=config)[0])
+        if cycles[1] > cycles[0]:
+            raise RuntimeError(f"{depth}-stage dual issue took {cycles[1]} cycles, single issue {cycles[0]}")
+        results[depth] = tuple(cycles)
+    print("Dual vs single issue: " + ", ".join(f"{depth}-stage {dual} vs {single} cycles" for depth, (single, dual) in results.items()))
+    return results
+
+
+def check_scheduling(instr_list, isa=cd.RV32I):
+    """Raises RuntimeError if branch-aware scheduling changes the program's final registers or memory.
+
+    Returns (unscheduled cycles, scheduled cycles) on the default pipeline.
+    """
+    results = []
+    for schedule in (False, True):
+        imem, rf, dmem = isa.assembler(), isa.register_file(), cd.DataMemory()
+        with contextlib.redirect_stdout(io.StringIO()):
+            imem.assemble(instr_list, schedule)
+            cycles = simulate(imem, rf, dmem)[0]
+        results.append((cycles, rf.reg, {a: b for a, b in dmem.mem.items() if b}))
+    if results[0][1:] != results[1][1:]:
+        changed = [f"x{reg}" for reg, value in results[0][1].items() if results[1][1].get(reg) != value]
+        raise RuntimeError(f"Scheduling changed the final state ({', '.join(changed) or 'memory'})")
+    print(f"Unscheduled vs scheduled: {results[0][0]} vs {results[1][0]} cycles, same final state")
+    return results[0][0], results[1][0]
+
+
 # --- MAIN PROGRAM ---
-imem, rf, dmem = cd.InstructionMemory(), cd.RegisterFile(), cd.DataMemory()
-# A comprehensive program to test the full RV32I ISA implementation
-import test_instruction as ti
-instr_list = ti.program.strip().split('\n')
-instructions, labels = imem.assemble(instr_list)
-
-print("="*60 + "\nPIPELINE SIMULATION WITH RISC-V 32I ISA\n" + "="*60)
-total_cycles, total_stalls = simulate(imem, rf, dmem)
-
-print("\n" + "="*60 + "\nSIMULATION SUMMARY\n" + "="*60)
-cpi = total_cycles / len(instructions) if instructions else 0
-print(f"Total Cycles: {total_cycles}")
-print(f"Total Instructions Executed: {len(instructions)}")
-print(f"Total System Stalls: {total_stalls}")
-print(f"CPI: {cpi:.2f}")
-
-rf.dump_registers()
-dmem.dump_memory()
\ No newline at end of file
+if __name__ == "__main__":
+    imem, rf, dmem = cd.InstructionMemory(), cd.RegisterFile(), cd.DataMemory()
+    # A comprehensive program to test the full RV32I ISA implementation
+    import test_instruction as ti
+    instr_list = ti.program.strip().split('\n')
+    instructions, labels = imem.assemble(instr_list)
+
+    print("="*60 + "\nPIPELINE SIMULATION WITH RISC-V 32I ISA\n" + "="*60)
+    stats = {}
+    total_cycles, total_stalls = simulate(imem, rf, dmem, stats=stats)
+
+    print("\n" + "="*60 + "\nSIMULATION SUMMARY\n" + "="*60)
+    cpi = total_cycles / len(instructions) if instructions else 0
+    print(f"Total Cycles: {total_cycles}")
+    print(f"Total Instructions Executed: {len(instructions)}")
+    print(f"Total System Stalls: {total_stalls}")
+    print(f"CPI: {cpi:.2f}")
+
+    rf.dump_registers()
+    dmem.dump_memory()
+    energy_report(stats)
+
+    for depth, config in PIPELINES.items():
+        for width in (1, 2):
+            compare_branch_policies(instr_list, width, config)
+            compare_branch_policies(ti.load_branch_program.strip().split('\n'), width, config)
+    # A fully dependent chain never pairs, so dual issue must not cost anything over single issue
+    check_dual_issue(ti.dependent_chain_program.strip().split('\n'))
+    # The same BPU hardware, with and without the assembler's branch-aware scheduling
+    for schedule in (False, True):
+        compare_branch_policies(ti.scheduling_program.strip().split('\n'), schedule=schedule)
+    for program in (ti.scheduling_program, ti.auipc_scheduling_program):
+        check_scheduling(program.strip().split('\n'))
+    # Cold caches, with and without the BPU look-ahead sharing the I-cache port
+    for bpu_icache_port in (False, True):
+        compare_branch_policies(ti.load_branch_program.strip().split('\n'), 1, PIPELINES[5], CACHE_CONFIG, CACHE_CONFIG,
+                                bpu_icache_port)
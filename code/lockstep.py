@@ -0,0 +1,190 @@
+"""Lockstep A/B run of the BPU pipeline against a baseline that resolves branches in EX.
+
+The program is executed once by an in-order functional model. That trace drives the baseline's
+timing and is the reference every instruction retiring from the BPU pipeline is checked against.
+"""
+import collections
+import contextlib
+import io
+import component_def as cd
+import full_pipeline_risc32i as fp
+
+ACCESS_BYTES = {"lb": 1, "lh": 2, "lw": 4, "lbu": 1, "lhu": 2, "sb": 1, "sh": 2, "sw": 4}
+# One record per dynamic instruction; `dest` is None for x0, `store` is (address, bytes, value)
+Retired = collections.namedtuple('Retired', ['pc', 'instr', 'dest', 'value', 'store', 'next_pc'])
+
+
+class DivergenceError(RuntimeError):
+    """The BPU pipeline's architectural state differs from the functional model's."""
+
+
+def functional_steps(imem, rf, dmem, syscalls=None, alu=None):
+    """Executes the program in order on `rf`/`dmem`, yielding a Retired record per instruction.
+
+    ecalls run on `syscalls` (a cd.SyscallHandler); the program ends at the ecall that exits.
+    `alu` is the ISA's ALU (cd.RISCV_ALU by default).
+    """
+    alu, comparator, pc = alu or cd.RISCV_ALU(), cd.Comparator(), 0
+    syscalls = cd.SyscallHandler() if syscalls is None else syscalls
+    imem.load_data(dmem)
+    while 0 <= pc < len(imem.instructions) * 4:
+        instr = imem.instructions[pc // 4]
+        rs1_val, rs2_val = rf.read(instr.rs1), rf.read(instr.rs2)
+        if instr.op == "ecall":
+            value, store, next_pc = None, None, pc + 4
+            syscalls.handle(rf, dmem)
+            if syscalls.exit_code is not None:
+                yield Retired(pc, instr, None, None, None, None)
+                return
+        else:
+            value, store, next_pc = functional_step(imem, instr, pc, rs1_val, rs2_val, dmem, alu, comparator)
+        dest = instr.get_dest_reg() if instr.get_dest_reg() != '0' else None
+        if dest: rf.write(dest, value)
+        yield Retired(pc, instr, dest, value if dest else None, store, next_pc)
+        pc = next_pc
+
+
+def functional_step(imem, instr, pc, rs1_val, rs2_val, dmem, alu, comparator):
+    """Executes one instruction other than ecall: returns (value, store, next PC), with `store` as in Retired."""
+    value, store, next_pc = alu.execute(instr, pc, rs1_val, rs2_val), None, pc + 4
+    branch_type = cd.BPUDecoder(instr).is_branch_type
+    if instr.op in cd.LOAD_OPS:
+        value = dmem.load(value, ACCESS_BYTES[instr.op], "u" not in instr.op)
+    elif instr.op in ACCESS_BYTES:
+        store = (value, ACCESS_BYTES[instr.op], rs2_val)
+        dmem.store(value, rs2_val, ACCESS_BYTES[instr.op])
+    elif branch_type == 1:
+        if comparator.is_taken(instr.op, rs1_val, rs2_val): next_pc = imem.label_dict.get(instr.imm)
+    elif branch_type == 2:
+        next_pc = (rs1_val + (instr.imm or 0)) & ~1
+    elif branch_type == 3:
+        next_pc = imem.label_dict.get(instr.imm)
+    return value, store, next_pc
+
+
+def functional_trace(imem, rf, dmem, max_steps=100000, syscalls=None, alu=None):
+    """The Retired records of the whole program (see functional_steps)."""
+    trace = []
+    for rec in functional_steps(imem, rf, dmem, syscalls, alu):
+        if len(trace) == max_steps: raise RuntimeError(f"Functional model did not finish within {max_steps} instructions")
+        trace.append(rec)
+    return trace
+
+
+def folded_by_bpu(rec):
+    """True for branches and jumps without a link register, which the BPU may resolve in fetch and drop."""
+    return rec.dest is None and bool(cd.BPUDecoder(rec.instr).is_branch_type)
+
+
+def ex_resolved_timing(trace, config, flush_penalty):
+    """Retirement cycle of every trace record on the baseline, and its total cycles.
+
+    The baseline is single-issue with the same depth, predicts not-taken and resolves every branch
+    and jump in the last EX stage, losing `flush_penalty` cycles when it is taken. Load-use stalls
+    follow the BPU pipeline's rule.
+    """
+    retire_offset = config.execute + config.memory + 1   # ID to WB
+    last_writer, retire, id_cycle = {}, [], config.fetch   # the first instruction reaches ID in cycle fetch + 1
+    for i, rec in enumerate(trace):
+        id_cycle += 1 + (flush_penalty if i and trace[i - 1].next_pc != trace[i - 1].pc + 4 else 0)
+        for reg in {rec.instr.rs1, rec.instr.rs2} - {None, '0'}:
+            writer = last_writer.get(reg)
+            if writer and writer[0] in cd.LOAD_OPS: id_cycle = max(id_cycle, writer[1] + config.memory + 1)
+        if rec.instr.get_dest_reg(): last_writer[rec.instr.get_dest_reg()] = (rec.instr.op, id_cycle)
+        retire.append(id_cycle + retire_offset)
+    return retire, retire[-1] if retire else 0
+
+
+def branch_site_costs(trace, retire):
+    """Cycles spent around each branch site: the retirement gap from the instruction before a dynamic
+    branch to the one after it, beyond the one cycle per instruction of an ideal pipeline.
+
+    `retire` maps trace positions to retirement cycles; a branch the BPU folded away has none.
+    """
+    sites = {}
+    for i, rec in enumerate(trace):
+        if not cd.BPUDecoder(rec.instr).is_branch_type or i == 0 or i + 1 == len(trace): continue
+        if i - 1 not in retire or i + 1 not in retire: continue
+        site = sites.setdefault(rec.pc, {'op': rec.instr.op, 'executions': 0, 'taken': 0, 'cycles': 0})
+        site['executions'] += 1
+        site['taken'] += rec.next_pc != rec.pc + 4
+        site['cycles'] += retire[i + 1] - retire[i - 1] - 2
+    return sites
+
+
+def lockstep_compare(instr_list, branch_policy="speculate", predictor="bimodal", issue_width=1, pipeline_config=None,
+                     flush_penalty=None, verbose=True, isa=cd.RV32I):
+    """Runs the BPU pipeline and the EX-resolved baseline side by side and reports per-branch-site savings.
+
+    `flush_penalty` defaults to the number of fetch and EX stages. Raises DivergenceError as soon
+    as an instruction retiring from the BPU pipeline disagrees with the functional model. `isa`
+    (a cd.ISA) supplies the assembler, ALU and register file of both.
+    """
+    config = pipeline_config or fp.PipelineConfig()
+    flush_penalty = config.fetch + config.execute if flush_penalty is None else flush_penalty
+    imem = isa.assembler()
+    imem.assemble(instr_list)
+    golden_rf, golden_dmem, golden_syscalls = isa.register_file(), cd.DataMemory(), cd.SyscallHandler()
+    with contextlib.redirect_stdout(io.StringIO()):
+        trace = functional_trace(imem, golden_rf, golden_dmem, syscalls=golden_syscalls, alu=isa.alu())
+    baseline_retire, baseline_cycles = ex_resolved_timing(trace, config, flush_penalty)
+
+    rf, dmem, bpu_retire, position = isa.register_file(), cd.DataMemory(), {}, 0
+
+    def check(instr, cycle):
+        nonlocal position
+        # Branches and jumps without a link register are dropped once the BPU resolves them in fetch
+        while position < len(trace) and trace[position].pc != instr.pc and folded_by_bpu(trace[position]):
+            position += 1
+        if position == len(trace):
+            raise DivergenceError(f"Cycle {cycle}: {instr.op} at PC {instr.pc:#x} retired after the program ended")
+        rec = trace[position]
+        if rec.pc != instr.pc:
+            raise DivergenceError(f"Cycle {cycle}: {instr.op} at PC {instr.pc:#x} retired, expected {rec.instr.op} at PC {rec.pc:#x}")
+        dest = instr.get_dest_reg() if instr.get_dest_reg() != '0' else None
+        if (dest, instr.result if dest else None) != (rec.dest, rec.value):
+            raise DivergenceError(f"Cycle {cycle}: {instr.op} at PC {instr.pc:#x} wrote x{dest}={instr.result if dest else None}, "
+                                  f"expected x{rec.dest}={rec.value}")
+        if rec.store:
+            address, num_bytes, value = rec.store
+            mask = (1 << 8 * num_bytes) - 1
+            if dmem.load(address, num_bytes, False) != value & mask:
+                raise DivergenceError(f"Cycle {cycle}: {instr.op} at PC {instr.pc:#x} left Mem[{address:#x}]="
+                                      f"{dmem.load(address, num_bytes, False):#x}, expected {value & mask:#x}")
+        bpu_retire[position] = cycle
+        position += 1
+
+    stats = {}
+    with contextlib.redirect_stdout(io.StringIO()):
+        fp.simulate(imem, rf, dmem, branch_policy=branch_policy, predictor=predictor, issue_width=issue_width,
+                    pipeline_config=config, stats=stats, on_retire=check, isa=isa)
+    if any(rec.dest is not None or rec.store for rec in trace[position:]):
+        raise DivergenceError(f"The BPU pipeline stopped retiring at PC {trace[position].pc:#x}")
+    if rf.reg != golden_rf.reg or {a: b for a, b in dmem.mem.items() if b} != {a: b for a, b in golden_dmem.mem.items() if b}:
+        raise DivergenceError("Final architectural state differs from the functional model")
+    if (stats['exit_code'], stats['stdout'], stats['stderr']) != \
+            (golden_syscalls.exit_code, bytes(golden_syscalls.stdout), bytes(golden_syscalls.stderr)):
+        raise DivergenceError("Exit code or console output differs from the functional model")
+
+    baseline_sites = branch_site_costs(trace, dict(enumerate(baseline_retire)))
+    bpu_sites = branch_site_costs(trace, bpu_retire)
+    sites = {pc: dict(site, baseline=site.pop('cycles'), bpu=bpu_sites.get(pc, {}).get('cycles', 0))
+             for pc, site in sorted(baseline_sites.items())}
+    for site in sites.values(): site['saved'] = site['baseline'] - site['bpu']
+    report = {'baseline_cycles': baseline_cycles, 'bpu_cycles': stats['cycles'], 'instructions': len(trace),
+              'speedup': baseline_cycles / stats['cycles'] if stats['cycles'] else 0.0, 'sites': sites, 'stats': stats}
+    if verbose:
+        print("\n" + "="*60 + f"\nLOCKSTEP A/B: BPU ({branch_policy}/{predictor}) vs EX-resolved (penalty {flush_penalty})\n" + "="*60)
+        for pc, site in sites.items():
+            print(f"PC 0x{pc:X} {site['op']:>5}: {site['executions']} executions ({site['taken']} taken), "
+                  f"baseline {site['baseline']} cycles, BPU {site['bpu']} cycles, {site['saved']} saved")
+        print(f"{len(trace)} instructions: baseline {baseline_cycles} cycles, BPU {stats['cycles']} cycles, "
+              f"speedup {report['speedup']:.2f}x")
+    return report
+
+
+if __name__ == "__main__":
+    import test_instruction as ti
+    for program in (ti.program, ti.load_branch_program):
+        for depth, config in fp.PIPELINES.items():
+            lockstep_compare(program.strip().split('\n'), pipeline_config=config)
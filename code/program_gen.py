@@ -0,0 +1,178 @@
+"""Seeded random RV32I programs that stress the BPU's dependency paths, and a sweep that runs them.
+
+Every generated program assembles and terminates: branches and jumps only go forward, except the
+back edge of a counted loop whose counter nothing else writes, and the program ends with an exit
+ecall. The same seed always gives the same program.
+"""
+import contextlib
+import io
+import random
+import time
+import component_def as cd
+import full_pipeline_risc32i as fp
+
+# s0 holds the scratch area's address and s1/s2 the loop counters; nothing else writes them
+WORK_REGS = ["t0", "t1", "t2", "t3", "t4", "t5", "t6", "a0", "a1", "a2", "a3", "a4", "a5"]
+LOOP_REGS = ["s1", "s2"]
+R_OPS = ["add", "sub", "xor", "or", "and", "sll", "srl", "sra", "slt", "sltu"]
+I_OPS = ["addi", "xori", "ori", "andi", "slli", "srli", "srai", "slti", "sltiu"]
+BRANCH_OPS = ["beq", "bne", "blt", "bge", "bltu", "bgeu"]
+LOAD_WIDTHS = {"lw": 4, "lh": 2, "lhu": 2, "lb": 1, "lbu": 1}
+STORE_WIDTHS = {"sw": 4, "sh": 2, "sb": 1}
+
+
+class ProgramGenerator:
+    """Builds one program. The block mix is set by the probabilities of each kind per block:
+
+    - `load_branch`: a load whose result a branch tests, `distance` instructions later
+    - `alu_branch`: the same with an ALU producer
+    - `jalr`: an indirect jump whose target register comes from `la` or, half the time, from a load
+    - `memory`: a load or store on the scratch area
+    - `loop`: a counted loop of 1..`max_trip` iterations around a few blocks, nested up to two deep
+
+    Any remaining probability is plain ALU work. `distance` is the most independent instructions
+    placed between a producer and its branch (0 keeps them adjacent).
+    """
+    def __init__(self, seed=0, load_branch=0.15, alu_branch=0.2, jalr=0.05, memory=0.15, loop=0.05,
+                 max_trip=8, distance=1, scratch_words=16):
+        if load_branch + alu_branch + jalr + memory + loop > 1: raise ValueError("block probabilities add up to more than 1")
+        self.rng = random.Random(seed)
+        self.weights = {"load_branch": load_branch, "alu_branch": alu_branch, "jalr": jalr, "memory": memory, "loop": loop}
+        self.max_trip, self.distance, self.scratch_words = max_trip, distance, scratch_words
+        self.lines, self.labels, self.size = [], 0, 0
+
+    def emit(self, line):
+        if not line.endswith(':'): self.size += 1
+        self.lines.append(line if line.endswith(':') else "    " + line)
+
+    def label(self, kind):
+        self.labels += 1
+        return f"{kind}_{self.labels}"
+
+    def offset(self, width=4):
+        return self.rng.randrange(0, self.scratch_words * 4, width)
+
+    def alu(self, rd=None, avoid=()):
+        rng = self.rng
+        rd = rd or rng.choice([r for r in WORK_REGS if r not in avoid])
+        sources = [r for r in WORK_REGS if r not in avoid] + ["x0"]
+        if rng.random() < 0.5:
+            self.emit(f"{rng.choice(R_OPS)} {rd}, {rng.choice(sources)}, {rng.choice(sources)}")
+        else:
+            op = rng.choice(I_OPS)
+            imm = rng.randrange(32) if op in ("slli", "srli", "srai") else rng.randint(-64, 63)
+            self.emit(f"{op} {rd}, {rng.choice(sources)}, {imm}")
+        return rd
+
+    def filler(self, keep):
+        # Independent work between a producer and its consumer; never writes `keep`
+        for _ in range(self.rng.randint(0, self.distance)): self.alu(avoid=keep)
+
+    def branch_over(self, reg):
+        rng, skip = self.rng, self.label("skip")
+        self.emit(f"{rng.choice(BRANCH_OPS)} {reg}, {rng.choice(WORK_REGS + ['x0'])}, {skip}")
+        for _ in range(rng.randint(1, 3)): self.alu()
+        self.emit(f"{skip}:")
+
+    def block(self, depth):
+        rng = self.rng
+        kinds = [k for k in self.weights if k != "loop" or depth < len(LOOP_REGS)]
+        roll, kind = rng.random(), "alu"
+        for k in kinds:
+            roll -= self.weights[k]
+            if roll < 0:
+                kind = k
+                break
+        if kind == "load_branch":
+            reg = rng.choice(WORK_REGS)
+            op = rng.choice(list(LOAD_WIDTHS))
+            self.emit(f"{op} {reg}, {self.offset(LOAD_WIDTHS[op])}(s0)")
+            self.filler([reg])
+            self.branch_over(reg)
+        elif kind == "alu_branch":
+            reg = self.alu()
+            self.filler([reg])
+            self.branch_over(reg)
+        elif kind == "jalr":
+            target, reg = self.label("target"), rng.choice(WORK_REGS)
+            self.emit(f"la {reg}, {target}")
+            if rng.random() < 0.5:
+                slot = self.offset()
+                self.emit(f"sw {reg}, {slot}(s0)")
+                self.filler([reg])
+                self.emit(f"lw {reg}, {slot}(s0)")
+            self.filler([reg])
+            self.emit(f"jalr {rng.choice(['x0', 'ra'])}, 0({reg})")
+            for _ in range(rng.randint(1, 2)): self.alu()
+            self.emit(f"{target}:")
+        elif kind == "memory":
+            reg = rng.choice(WORK_REGS)
+            if rng.random() < 0.5:
+                op = rng.choice(list(LOAD_WIDTHS))
+                self.emit(f"{op} {reg}, {self.offset(LOAD_WIDTHS[op])}(s0)")
+            else:
+                op = rng.choice(list(STORE_WIDTHS))
+                self.emit(f"{op} {reg}, {self.offset(STORE_WIDTHS[op])}(s0)")
+        elif kind == "loop":
+            counter, top = LOOP_REGS[depth], self.label("loop")
+            self.emit(f"li {counter}, {rng.randint(1, self.max_trip)}")
+            self.emit(f"{top}:")
+            for _ in range(rng.randint(2, 5)): self.block(depth + 1)
+            self.emit(f"addi {counter}, {counter}, -1")
+            self.emit(f"bnez {counter}, {top}")
+        else:
+            self.alu()
+
+    def program(self, length):
+        rng = self.rng
+        self.lines = [".data", "scratch:"] + [f"    .word {rng.randrange(-8, 9)}" for _ in range(self.scratch_words)] + [".text"]
+        self.emit("la s0, scratch")
+        for reg in WORK_REGS: self.emit(f"li {reg}, {rng.randint(-8, 8)}")
+        while self.size < length: self.block(0)
+        self.emit("li a7, 93")
+        self.emit("ecall")
+        return self.lines
+
+
+def generate_program(length=200, seed=0, **mix):
+    """Returns the assembly lines of a random program of about `length` static instructions.
+
+    `mix` takes the ProgramGenerator options (block probabilities, max_trip, distance, scratch_words).
+    """
+    return ProgramGenerator(seed, **mix).program(length)
+
+
+def stress(lengths=(100, 400, 1600), seeds=range(3), configs=(("stall", "not-taken"), ("speculate", "bimodal")), verbose=True,
+           **mix):
+    """Simulates generated programs and reports BPU stall rates and simulator throughput.
+
+    Returns one row per (length, seed, policy, predictor) with the retired instruction count,
+    cycles, stalls, stalls per retired instruction and simulated cycles per second.
+    """
+    rows = []
+    for length in lengths:
+        for seed in seeds:
+            lines = generate_program(length, seed, **mix)
+            for policy, predictor in configs:
+                imem, stats, retired = cd.InstructionMemory(), {}, []
+                with contextlib.redirect_stdout(io.StringIO()):
+                    imem.assemble(lines)
+                    start = time.perf_counter()
+                    cycles, stalls = fp.simulate(imem, cd.RegisterFile(), cd.DataMemory(), policy, predictor, stats=stats,
+                                                 on_retire=lambda instr, cycle: retired.append(cycle))
+                    seconds = time.perf_counter() - start
+                rows.append({'length': length, 'seed': seed, 'policy': policy, 'predictor': predictor,
+                             'retired': len(retired), 'cycles': cycles, 'stalls': stalls,
+                             'stall_rate': stalls / len(retired) if retired else 0.0,
+                             'mispredicts': stats['mispredicts'], 'cycles_per_second': cycles / seconds if seconds else 0.0})
+    if verbose:
+        print("\n" + "="*60 + "\nSTRESS: generated dependency-heavy programs\n" + "="*60)
+        for r in rows:
+            print(f"{r['length']:>5} instrs, seed {r['seed']}, {r['policy']:>9}/{r['predictor']:<9}: {r['retired']:>6} retired, "
+                  f"{r['cycles']:>6} cycles, {r['stalls']:>5} stalls ({r['stall_rate']:.2f}/instr), "
+                  f"{r['mispredicts']:>4} mispredicts, {r['cycles_per_second']:,.0f} cycles/s")
+    return rows
+
+
+if __name__ == "__main__":
+    stress()
@@ -0,0 +1,196 @@
+"""Warm simulation server: JSON jobs over a Unix domain socket, run on a pool of warm worker processes.
+
+Workers import the simulator once and keep every program they assemble, so a job only pays for
+its simulation. Each connection sends one JSON job per line and receives one JSON reply per line,
+in completion order, as soon as each job finishes:
+
+    {"id": 7, "program": {"builtin": "load_branch_program"}, "isa": "RV32I", "max_cycles": 5000,
+     "config": {"branch_policy": "speculate", "predictor": "bimodal", "pipeline": 7, "issue_width": 1}}
+    -> {"id": 7, "status": "ok", "stats": {"cycles": ..., "stalls": ..., ...}}
+
+A program is referenced as {"source": text}, {"file": path}, {"builtin": name in test_instruction}
+or {"generate": program_gen.generate_program arguments}. {"op": "shutdown"} stops the server: jobs
+already received still get their replies, and later lines on any connection get an error reply.
+"""
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import json
+import os
+import time
+import component_def as cd
+import full_pipeline_risc32i as fp
+import program_gen as pg
+import sim
+import test_instruction as ti
+
+SOCKET_PATH = "/tmp/bpu_sim.sock"
+ISAS = {"RV32I": cd.RV32I, "MIPS": sim.MIPS}
+_programs = collections.OrderedDict()   # per worker: program key -> assembled InstructionMemory, most recent last
+
+
+def load_program(ref, isa="RV32I", schedule=False):
+    """The assembled program for a reference, assembling it on first use in this process.
+
+    A file is keyed by its contents, so an edited file is assembled again. Each worker keeps the
+    cd.ASSEMBLY_CACHE_SIZE most recently used programs.
+    """
+    assembler = ISAS[isa].assembler
+    key = (isa, assembler.file_key(ref["file"], schedule) if "file" in ref else json.dumps(ref, sort_keys=True), bool(schedule))
+    if key not in _programs:
+        imem = assembler()
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            if "file" in ref: imem.assemble_file(ref["file"], schedule)
+            elif "builtin" in ref: imem.assemble(getattr(ti, ref["builtin"]).strip().split('\n'), schedule)
+            elif "generate" in ref: imem.assemble(pg.generate_program(**ref["generate"]), schedule)
+            else: imem.assemble(ref["source"].strip().split('\n'), schedule)
+        _programs[key] = imem
+        if len(_programs) > cd.ASSEMBLY_CACHE_SIZE: _programs.popitem(last=False)
+    _programs.move_to_end(key)
+    return _programs[key]
+
+
+def _warm_worker(preload):
+    for job in preload: load_program(job["program"], job.get("isa", "RV32I"), job.get("config", {}).get("schedule"))
+
+
+def _jsonable(value):
+    if isinstance(value, dict): return {str(k): _jsonable(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)): return [_jsonable(v) for v in value]
+    if isinstance(value, bytes): return value.decode(errors="replace")
+    return value
+
+
+def run_job(job):
+    """Runs one job in a worker and returns its stats (JSON-ready), plus `seconds` of simulation."""
+    isa, config = job.get("isa", "RV32I"), job.get("config", {})
+    imem = load_program(job["program"], isa, config.get("schedule"))
+    pipeline = config.get("pipeline", 5)
+    pipeline = fp.PIPELINES[pipeline] if isinstance(pipeline, int) else fp.PipelineConfig(*pipeline)
+    caches = {}
+    for name in ("icache", "dcache"):
+        if config.get(name):
+            caches[name] = cd.Cache(name, **(fp.CACHE_CONFIG if config[name] is True else config[name]))
+    stats, start = {}, time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        fp.simulate(imem, ISAS[isa].register_file(), cd.DataMemory(), branch_policy=config.get("branch_policy", "stall"),
+                    predictor=config.get("predictor", "not-taken"), issue_width=config.get("issue_width", 1),
+                    pipeline_config=pipeline, stats=stats, bpu_icache_port=config.get("bpu_icache_port", False),
+                    syscalls=cd.SyscallHandler(job.get("stdin", "").encode()), isa=ISAS[isa],
+                    max_cycles=job.get("max_cycles"), **caches)
+    stats['seconds'] = time.perf_counter() - start
+    return _jsonable(stats)
+
+
+def _execute(job):
+    # Errors travel back as text: not every exception survives pickling (AssemblyError does not)
+    try: return {"status": "ok", "stats": run_job(job)}
+    except Exception as e: return {"status": "error", "error": f"{type(e).__name__}: {e}"}
+
+
+class SimulationServer:
+    """Accepts jobs on `socket_path` and runs them on `workers` processes (default: one per CPU).
+
+    `preload` jobs have their programs assembled in every worker at start-up.
+    """
+    def __init__(self, socket_path=SOCKET_PATH, workers=None, preload=()):
+        self.socket_path, self.workers, self.preload = socket_path, workers or os.cpu_count(), list(preload)
+        self.jobs_done, self.pool, self.stopped = 0, None, None
+        self.connections = {}   # writer -> (connection task, its job tasks)
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        self.pool = concurrent.futures.ProcessPoolExecutor(self.workers, initializer=_warm_worker, initargs=(self.preload,))
+        # Start every worker now rather than on the first jobs
+        await asyncio.gather(*(loop.run_in_executor(self.pool, time.sleep, 0.05) for _ in range(self.workers)))
+        with contextlib.suppress(FileNotFoundError): os.unlink(self.socket_path)
+        server = await asyncio.start_unix_server(self.handle, path=self.socket_path)
+        print(f"[SERVER] {self.workers} warm worker(s) listening on {self.socket_path}")
+        try:
+            async with server:
+                await self.stopped.wait()
+                server.close()
+                # Every job received before the shutdown finishes and is answered before its connection closes
+                while pending := [task for _, tasks in self.connections.values() for task in tasks if not task.done()]:
+                    await asyncio.wait(pending)
+                connections = [connection for connection, _ in self.connections.values()]
+                for writer in list(self.connections): writer.close()
+                await asyncio.gather(*connections, return_exceptions=True)
+        finally:
+            # Waiting for the workers to exit must not block the event loop
+            await loop.run_in_executor(None, self.pool.shutdown)
+            with contextlib.suppress(FileNotFoundError): os.unlink(self.socket_path)
+            print(f"[SERVER] Stopped after {self.jobs_done} job(s)")
+
+    async def handle(self, reader, writer):
+        lock, tasks = asyncio.Lock(), []
+        self.connections[writer] = (asyncio.current_task(), tasks)
+
+        async def reply(message):
+            async with lock:
+                if writer.is_closing(): return
+                writer.write((json.dumps(message) + "\n").encode())
+                with contextlib.suppress(ConnectionError): await writer.drain()
+
+        async def run(job):
+            try: message = {"id": job.get("id"), **await asyncio.get_running_loop().run_in_executor(self.pool, _execute, job)}
+            except Exception as e: message = {"id": job.get("id"), "status": "error", "error": f"{type(e).__name__}: {e}"}
+            self.jobs_done += 1
+            await reply(message)
+
+        try:
+            async for line in reader:
+                if not line.strip(): continue
+                try: job = json.loads(line)
+                except ValueError as e:
+                    await reply({"id": None, "status": "error", "error": f"bad request: {e}"})
+                    continue
+                if not isinstance(job, dict):
+                    await reply({"id": None, "status": "error", "error": "bad request: a job must be a JSON object"})
+                    continue
+                if self.stopped.is_set():
+                    await reply({"id": job.get("id"), "status": "error", "error": "server is shutting down"})
+                    continue
+                if job.get("op") == "shutdown":
+                    self.stopped.set()
+                    continue
+                tasks.append(asyncio.create_task(run(job)))
+            await asyncio.gather(*tasks)
+        finally:
+            del self.connections[writer]
+            writer.close()
+
+
+async def stream_jobs(jobs, socket_path=SOCKET_PATH):
+    """Sends `jobs` (ids default to their index) and yields each reply as it arrives."""
+    reader, writer = await asyncio.open_unix_connection(socket_path)
+    for i, job in enumerate(jobs):
+        writer.write((json.dumps(dict(job, id=job.get("id", i))) + "\n").encode())
+    await writer.drain()
+    writer.write_eof()
+    async for line in reader: yield json.loads(line)
+    writer.close()
+
+
+def run_jobs(jobs, socket_path=SOCKET_PATH):
+    """Runs `jobs` on a server and returns the replies in job order."""
+    async def collect():
+        return {reply["id"]: reply async for reply in stream_jobs(jobs, socket_path)}
+    replies = asyncio.run(collect())
+    return [replies.get(job.get("id", i)) for i, job in enumerate(jobs)]
+
+
+def shutdown(socket_path=SOCKET_PATH):
+    async def send():
+        reader, writer = await asyncio.open_unix_connection(socket_path)
+        writer.write(b'{"op": "shutdown"}\n')
+        await writer.drain()
+        writer.close()
+    asyncio.run(send())
+
+
+if __name__ == "__main__":
+    import sys
+    asyncio.run(SimulationServer(sys.argv[1] if len(sys.argv) > 1 else SOCKET_PATH).serve())
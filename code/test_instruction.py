@@ -9,4 +9,52 @@ taken:
     addi x7, x0, 2      # x7 = 2
 done:
     nop
-"""
\ No newline at end of file
+"""
+# Load-to-branch dependencies: exercises the BPU's load stall / late-resolution paths
+load_branch_program = """
+_start:
+    addi x5, x0, 3      # x5 = 3
+    addi x10, x0, 0     # x10 = counter address
+    sw   x5, 0(x10)     # mem[0] = 3
+loop:
+    lw   x6, 0(x10)     # x6 = remaining iterations
+    beq  x6, x0, done   # branch on freshly loaded value
+    addi x6, x6, -1
+    sw   x6, 0(x10)
+    addi x7, x7, 1      # x7 = iterations executed
+    beq  x0, x0, loop
+done:
+    nop
+"""
+# A loop-exit test on a load placed right before its branch, with independent work above it that the
+# assembler's scheduling pass can hoist between them (it cannot pass the store)
+scheduling_program = """
+_start:
+    addi x10, x0, 0     # x10 = counter address
+    addi x5, x0, 4
+    sw   x5, 0(x10)     # mem[0] = 4
+loop:
+    lw   x6, 0(x10)
+    addi x6, x6, -1
+    sw   x6, 0(x10)     # mem[0] -= 1
+    addi x7, x7, 1      # x7 = iterations executed
+    addi x8, x8, 2      # x8 = 2 * iterations
+    lw   x9, 0(x10)     # reload the counter for the exit test
+    bne  x9, x0, loop
+done:
+    nop
+"""
+# Every instruction depends on the one before it, so no two of them can pair in dual issue
+# An auipc between a branch operand's producer and the branch: auipc adds its own PC, so the
+# scheduling pass must not hoist the producer past it
+auipc_scheduling_program = """
+_start:
+    addi x7, x0, 1
+    auipc x5, 0
+    addi x6, x0, 3
+    beq  x6, x0, out
+    addi x8, x5, 0
+out:
+    nop
+"""
+dependent_chain_program = "\n".join(["_start:"] + ["    addi x1, x1, 1"] * 40)